@@ -0,0 +1,283 @@
+# Connection broker for the iRODS tools.
+#
+# The broker is an optional long-running process on the Galaxy node. It keeps authenticated iRODS sessions warm per
+# (host, port, zone, user) and runs listings and transfers for the tool runs, which talk to it over a Unix socket.
+# Tool runs find the broker automatically and fall back to their own iRODS session if no broker is running.
+#
+# Start it as the Galaxy user, e.g.:
+#   python irods_broker.py --socket ~/.irods_galaxy_broker.sock --pool-size 8
+#
+# Protocol: one JSON request per line, answered with one JSON response line {"ok": true, "result": ...} or
+# {"ok": false, "error": "..."}.
+
+import os
+import sys
+import json
+import socket
+import hashlib
+import argparse
+import threading
+import socketserver
+
+from contextlib import contextmanager
+from irods_transfer import DEFAULT_WORKERS, SessionPool
+
+# default location of the broker socket
+DEFAULT_BROKER_SOCKET = os.path.join(os.path.expanduser("~"), ".irods_galaxy_broker.sock")
+
+
+########################################################################################################################
+#   Client connection to the broker
+#
+#   IN:
+#   String socket_path
+#   Dict credentials (host, port, zone, user and password)
+#
+########################################################################################################################
+class BrokerClient:
+    def __init__(self, socket_path, credentials):
+        self.credentials = credentials
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.connection.connect(socket_path)
+        self.responses = self.connection.makefile("rb")
+
+    def request(self, op, **arguments):
+        message = dict(arguments, op=op, credentials=self.credentials)
+        self.connection.sendall((json.dumps(message, default=str) + "\n").encode("utf-8"))
+
+        line = self.responses.readline()
+        if not line:
+            raise Exception("iRODS broker closed the connection")
+        response = json.loads(line.decode("utf-8"))
+        if not response.get("ok"):
+            raise Exception(response.get("error") or "iRODS broker request failed")
+
+        return response.get("result")
+
+    def close(self):
+        try:
+            self.responses.close()
+            self.connection.close()
+        except OSError:
+            pass
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Pool of broker connections - can be used in place of a SessionPool for parallel transfers
+#
+#   IN:
+#   String socket_path
+#   Dict credentials
+#   Int size
+#
+########################################################################################################################
+class BrokerPool:
+    def __init__(self, socket_path, credentials, size):
+        self.clients = [BrokerClient(socket_path, credentials) for _ in range(max(1, size))]
+        self.idle = list(self.clients)
+        self.available = threading.Condition()
+
+    @contextmanager
+    def session(self):
+        with self.available:
+            while not self.idle:
+                self.available.wait()
+            client = self.idle.pop()
+        try:
+            yield client
+        finally:
+            with self.available:
+                self.idle.append(client)
+                self.available.notify()
+
+    def cleanup(self):
+        for client in self.clients:
+            client.close()
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Returns a connected broker client if a broker is listening on socket_path, otherwise None
+#
+#   IN:
+#   String socket_path
+#   Dict credentials
+#
+#   OUT:
+#   BrokerClient client (or None)
+#
+########################################################################################################################
+def find_broker(socket_path, credentials):
+
+    if not socket_path or not os.path.exists(socket_path):
+        return None
+
+    try:
+        client = BrokerClient(socket_path, credentials)
+        client.request("ping")
+    except Exception:
+        return None
+
+    return client
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Broker server - holds one SessionPool per set of credentials
+#
+########################################################################################################################
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, pool_size):
+        self.pool_size = pool_size
+        self.pools = {}
+        self.pools_lock = threading.Lock()
+        socketserver.UnixStreamServer.__init__(self, socket_path, BrokerHandler)
+
+    def get_pool(self, credentials):
+        import irods_main
+
+        key = (credentials["host"], str(credentials["port"]), credentials["zone"], credentials["user"],
+               hashlib.sha256(credentials["password"].encode("utf-8")).hexdigest())
+
+        with self.pools_lock:
+            if key not in self.pools:
+                def connect():
+                    return irods_main.get_iRODS_connection(host=credentials["host"], port=credentials["port"],
+                                                           user=credentials["user"], password=credentials["password"],
+                                                           zone=credentials["zone"])
+
+                pool = SessionPool(connect, self.pool_size)
+                # validate the login once - later requests with the same credentials reuse the warm sessions
+                with pool.session() as pooled_session:
+                    try:
+                        irods_main.retry_policy.call(pooled_session.collections.get,
+                                                     "/" + credentials["zone"] + "/home/" + credentials["user"])
+                    except Exception:
+                        pool.cleanup()
+                        raise Exception("Invalid Login")
+                self.pools[key] = pool
+
+            return self.pools[key]
+
+    def cleanup(self):
+        with self.pools_lock:
+            for pool in self.pools.values():
+                pool.cleanup()
+            self.pools = {}
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Handles the requests of one client connection
+#
+########################################################################################################################
+class BrokerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = {"ok": True, "result": self.run_request(json.loads(line.decode("utf-8")))}
+            except Exception as e:
+                response = {"ok": False, "error": str(e) or e.__class__.__name__}
+            self.wfile.write((json.dumps(response, default=str) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+    def run_request(self, request):
+        # the tool functions are shared with irods_main, so brokered transfers behave exactly like local ones
+        import irods_main
+
+        op = request.get("op")
+        if op == "ping":
+            return "pong"
+
+        with self.server.get_pool(request["credentials"]).session() as pooled_session:
+            if op == "login":
+                return True
+
+            if op == "list":
+                file_list = irods_main.list_iRODS_collection(pooled_session, request["path"],
+                                                             request.get("recursive", True))
+                if not file_list:
+                    pooled_session.collections.get(request["path"])
+                return file_list
+
+            if op == "download":
+                params = request.get("params", {})
+                cache = None
+                if irods_main.get_setting(params, "cache_dir", "") != "":
+                    cache = irods_main.DownloadCache(irods_main.get_setting(params, "cache_dir", ""),
+                                                     irods_main.get_setting(params, "cache_max_size",
+                                                                            irods_main.DEFAULT_CACHE_SIZE))
+                name = irods_main.download_iRODS_file(pooled_session, request["file_entry"], params,
+                                                      request["buffer_size"], cache)
+                return {"name": name, "file_entry": request["file_entry"]}
+
+            if op == "vault_path":
+                return irods_main.get_vault_path(pooled_session, request["file_entry"], request["vault_mounts"])
+
+            if op == "download_bundle":
+                bundled, missing = irods_main.download_bundle(pooled_session, request["coll_path"],
+                                                              request["file_list"], request.get("params", {}),
+                                                              request["buffer_size"])
+                return [f["path"] for f in bundled], [f["path"] for f in missing]
+
+            if op == "upload_collection":
+                return irods_main.get_upload_collection(pooled_session, request.get("params", {}))
+
+            if op == "upload_bundle":
+                return irods_main.upload_bundle(pooled_session, request["file_list"], request.get("params", {}),
+                                                request["coll_path"], request["buffer_size"])
+
+            if op == "upload":
+                return irods_main.upload_iRODS_file(pooled_session, request["local_path"], request["name"],
+                                                    request.get("params", {}), request.get("coll_path"),
+                                                    request.get("buffer_size"))
+
+        raise Exception("Unknown broker request: " + str(op))
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Starts the broker
+#
+########################################################################################################################
+def main():
+
+    parser = argparse.ArgumentParser(description="Keeps iRODS sessions warm for the Galaxy iRODS tools")
+    parser.add_argument("--socket", default=os.environ.get("IRODS_GALAXY_BROKER_SOCKET", DEFAULT_BROKER_SOCKET))
+    parser.add_argument("--pool-size", type=int, default=2 * DEFAULT_WORKERS)
+    args = parser.parse_args()
+
+    # timeouts and retries of the broker sessions are configured with the IRODS_GALAXY_* environment variables
+    import irods_main
+    irods_main.iRODSTimeouts = irods_main.get_timeouts({})
+    irods_main.retry_policy = irods_main.get_retry_policy({})
+
+    if os.path.exists(args.socket):
+        if find_broker(args.socket, {}) is not None:
+            sys.exit("An iRODS broker is already listening on " + args.socket)
+        # stale socket of a broker that didn't shut down cleanly
+        os.remove(args.socket)
+
+    # only the Galaxy user may talk to the broker
+    old_umask = os.umask(0o177)
+    try:
+        server = BrokerServer(args.socket, args.pool_size)
+    finally:
+        os.umask(old_umask)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.cleanup()
+        os.remove(args.socket)
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+if __name__ == "__main__":
+    main()
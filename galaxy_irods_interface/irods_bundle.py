@@ -0,0 +1,177 @@
+# Tar bundles for transfers of many small files.
+#
+# The catalog latency of one create, open and close per data object dominates transfers of small files. Bundles pack
+# many small files into one tar stream, which is transferred as a single data object and extracted (and registered)
+# by iRODS itself with its structured file microservices - the same facility ibun uses. Downloads work the other way
+# round: iRODS packs the collection into a tar data object, which is unpacked locally while it streams.
+
+import tarfile
+
+from irods_transfer import stream_copy
+
+# files up to this size (bytes) are bundled
+DEFAULT_BUNDLE_FILE_SIZE = 1024 * 1024
+# bundles are only used for at least this many small files
+DEFAULT_BUNDLE_MIN_FILES = 32
+# upper bound of the size of one bundle in bytes
+DEFAULT_BUNDLE_MAX_SIZE = 256 * 1024 * 1024
+
+# rule that extracts a tar data object into a collection and registers its members
+EXTRACT_RULE = "galaxy_bundle_extract { msiTarFileExtract(*tar, *coll, *resc, *status); }"
+# rule that packs a collection into a tar data object
+CREATE_RULE = "galaxy_bundle_create { msiTarFileCreate(*tar, *coll, *resc, *flag); }"
+
+
+########################################################################################################################
+#   Splits the files of a transfer into bundles of small files and files that are transferred one by one. Bundles are
+#   only made if there are enough small files to make up for the extraction step.
+#
+#   IN:
+#   List file_list (dicts with the "size" of each file)
+#   Int min_files
+#   Int max_file_size
+#   Int max_bundle_size
+#
+#   OUT:
+#   List bundles (lists of files)
+#   List single_files
+#
+########################################################################################################################
+def plan_bundles(file_list, min_files=DEFAULT_BUNDLE_MIN_FILES, max_file_size=DEFAULT_BUNDLE_FILE_SIZE,
+                 max_bundle_size=DEFAULT_BUNDLE_MAX_SIZE):
+
+    small_files = [f for f in file_list if f["size"] <= max_file_size]
+    if len(small_files) < max(1, min_files):
+        return [], list(file_list)
+
+    bundles = []
+    bundle = []
+    bundle_size = 0
+    for f in small_files:
+        if bundle and bundle_size + f["size"] > max_bundle_size:
+            bundles.append(bundle)
+            bundle = []
+            bundle_size = 0
+        bundle.append(f)
+        bundle_size += f["size"]
+    if bundle:
+        bundles.append(bundle)
+
+    return bundles, [f for f in file_list if f["size"] > max_file_size]
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Writes local files as a tar stream into a writable file object - the stream is never seeked, so it can go
+#   directly into an iRODS data object
+#
+#   IN:
+#   File-object sink
+#   List members (list of (local_path, member_name))
+#   Int buffer_size
+#
+#   OUT:
+#
+########################################################################################################################
+def write_bundle(sink, members, buffer_size=tarfile.RECORDSIZE):
+
+    with tarfile.open(fileobj=sink, mode="w|", bufsize=max(tarfile.RECORDSIZE, buffer_size)) as tar:
+        for local_path, member_name in members:
+            tar.add(local_path, arcname=member_name, recursive=False)
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Extracts a tar data object into a collection on the iRODS server
+#
+#   IN:
+#   iRODSSession-object session
+#   String tar_path
+#   String coll_path
+#   String resource (empty for the default resource)
+#
+#   OUT:
+#
+########################################################################################################################
+def extract_bundle(session, tar_path, coll_path, resource=""):
+
+    run_bundle_rule(session, EXTRACT_RULE, {"*tar": tar_path, "*coll": coll_path, "*resc": resource or "null"})
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Packs a collection (with all subcollections) into a tar data object on the iRODS server
+#
+#   IN:
+#   iRODSSession-object session
+#   String tar_path
+#   String coll_path
+#   String resource (empty for the default resource)
+#
+#   OUT:
+#
+########################################################################################################################
+def create_bundle(session, tar_path, coll_path, resource=""):
+
+    run_bundle_rule(session, CREATE_RULE, {"*tar": tar_path, "*coll": coll_path, "*resc": resource or "null",
+                                           "*flag": "force"})
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Runs one of the bundle rules with string parameters
+#
+#   IN:
+#   iRODSSession-object session
+#   String body
+#   Dict rule_params
+#
+#   OUT:
+#
+########################################################################################################################
+def run_bundle_rule(session, body, rule_params):
+    from irods.rule import Rule
+
+    def quote(value):
+        return '"' + value.replace('"', '\\"') + '"'
+
+    rule = Rule(session, body=body, params={key: quote(value) for key, value in rule_params.items()},
+                output="ruleExecOut")
+    rule.execute()
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Unpacks a tar stream into local files while it is read. Only regular files that are expected are written, and
+#   always to the local path chosen by the caller - member names are never used as local paths, so absolute paths,
+#   ".." components and links in the archive can't write outside the working directory. Members are expected under
+#   their path relative to the bundled collection, optionally prefixed with the name of the collection.
+#
+#   IN:
+#   File-object source
+#   Dict members (relative path -> (local_path, TransferDigest or None))
+#   Int buffer_size
+#   Dict received (relative path -> bytes written, filled while unpacking - also valid after an error)
+#
+#   OUT:
+#
+########################################################################################################################
+def unpack_bundle(source, members, buffer_size, received):
+
+    with tarfile.open(fileobj=source, mode="r|", bufsize=max(tarfile.RECORDSIZE, buffer_size)) as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+
+            name = member.name
+            while name.startswith("./"):
+                name = name[2:]
+            if name not in members and "/" in name:
+                name = name.split("/", 1)[1]
+            if name not in members or name in received:
+                continue
+
+            local_path, digest = members[name]
+            with open(local_path, "wb") as local_file:
+                received[name] = stream_copy(tar.extractfile(member), local_file, buffer_size, digest)
+# -------------------------------------------------------------------------------------------------------------------- #
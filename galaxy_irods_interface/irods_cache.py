@@ -0,0 +1,118 @@
+# Persistent local cache for downloaded iRODS data objects.
+#
+# Cache entries are keyed by the iRODS path, checksum, size and modify time of the object, so a changed object is
+# never served from the cache. Jobs that request the same object at the same time wait on a file lock for a single
+# transfer. The least recently used entries are removed when the cache grows beyond its size limit.
+
+import os
+import errno
+import fcntl
+import shutil
+import hashlib
+import threading
+
+# default size limit of the cache in bytes
+DEFAULT_CACHE_SIZE = 50 * 1024 * 1024 * 1024
+
+
+########################################################################################################################
+#   Download cache class
+#
+#   IN:
+#   String cache_dir
+#   Int max_size
+#
+########################################################################################################################
+class DownloadCache:
+    def __init__(self, cache_dir, max_size=DEFAULT_CACHE_SIZE):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_entry_path(self, file_entry):
+        key = "\0".join([file_entry["path"], str(file_entry.get("checksum") or ""), str(file_entry.get("size")),
+                         str(file_entry.get("modify_time"))])
+        # decompressed and converted copies of an object are separate entries
+        for transform in ("compression", "convert_lines"):
+            if file_entry.get(transform):
+                key += "\0" + file_entry[transform]
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    # provides the object at local_path - download(target_path) is only called if the object isn't cached yet
+    def fetch(self, file_entry, local_path, download):
+        entry_path = self.get_entry_path(file_entry)
+
+        with open(entry_path + ".lock", "a") as lock_file:
+            # jobs requesting the same object wait here until the first one finished the transfer
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                hit = os.path.isfile(entry_path)
+                if not hit:
+                    part_path = entry_path + ".part." + str(os.getpid()) + "." + str(threading.get_ident())
+                    try:
+                        download(part_path)
+                        # entries are shared by hardlinks - nobody may change them in place
+                        os.chmod(part_path, 0o444)
+                        os.replace(part_path, entry_path)
+                    except Exception:
+                        if os.path.exists(part_path):
+                            os.remove(part_path)
+                        raise
+
+                # mark the entry as recently used
+                os.utime(entry_path)
+                self.link(entry_path, local_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        if not hit:
+            self.evict(keep=entry_path)
+
+        return hit
+
+    # hardlinks the cache entry to local_path, or copies it if the cache is on another file system
+    @staticmethod
+    def link(entry_path, local_path):
+        if os.path.lexists(local_path):
+            os.remove(local_path)
+        try:
+            os.link(entry_path, local_path)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+            shutil.copyfile(entry_path, local_path)
+
+    # removes the least recently used entries until the cache fits into max_size
+    def evict(self, keep=None):
+        entries = []
+        total_size = 0
+        for entry_name in os.listdir(self.cache_dir):
+            # lock files and partial downloads have a suffix
+            if "." in entry_name:
+                continue
+            entry_path = os.path.join(self.cache_dir, entry_name)
+            try:
+                entry_stat = os.stat(entry_path)
+            except OSError:
+                continue
+            total_size += entry_stat.st_size
+            if entry_path != keep:
+                entries.append((entry_stat.st_mtime, entry_stat.st_size, entry_path))
+
+        for _, entry_size, entry_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            with open(entry_path + ".lock", "a") as lock_file:
+                # entries that are used right now are skipped
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+                try:
+                    os.remove(entry_path)
+                    total_size -= entry_size
+                except OSError:
+                    pass
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+# -------------------------------------------------------------------------------------------------------------------- #
@@ -0,0 +1,236 @@
+# Wire compression for the iRODS tools.
+#
+# Compressed uploads are compressed while they stream and stored with a suffix (.gz or .zst) and the AVU
+# galaxy_irods::compression. On download, objects with one of these suffixes are decompressed while they stream,
+# so the data crosses the network compressed and lands uncompressed in Galaxy. zstd needs the optional "zstandard"
+# package, gzip only needs the standard library.
+
+import zlib
+
+# suffix of the stored objects per compression method
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+# default compression level per method - fast levels, the network is the bottleneck
+DEFAULT_COMPRESSION_LEVELS = {"gzip": 1, "zstd": 3}
+# files with these suffixes are compressed already and are sent as they are
+COMPRESSED_SUFFIXES = (".gz", ".zst", ".bz2", ".xz", ".zip", ".bam", ".cram", ".bcf", ".png", ".jpg")
+
+# metadata of compressed objects
+COMPRESSION_ATTRIBUTE = "galaxy_irods::compression"
+ORIGINAL_SIZE_ATTRIBUTE = "galaxy_irods::original_size"
+
+
+########################################################################################################################
+#   Checks a compression setting and returns the method ("gzip", "zstd" or None for uncompressed transfers)
+#
+#   IN:
+#   String method
+#
+#   OUT:
+#   String method
+#
+########################################################################################################################
+def get_compression(method):
+
+    method = str(method or "").strip().lower()
+    if method in ("", "none", "false", "off"):
+        return None
+    if method in ("gz", "true", "on"):
+        method = "gzip"
+    if method in ("zst", "zstandard"):
+        method = "zstd"
+    if method not in COMPRESSION_SUFFIXES:
+        raise Exception("Unknown compression method: " + method)
+
+    if method == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("zstd compression needs the zstandard package - use gzip instead")
+
+    return method
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Returns the compression method of a stored object from its name, or None
+#
+#   IN:
+#   String name
+#
+#   OUT:
+#   String method
+#
+########################################################################################################################
+def get_compression_of_name(name):
+
+    for method, suffix in COMPRESSION_SUFFIXES.items():
+        if name.endswith(suffix):
+            return method
+
+    return None
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Returns a compressor object (with compress and flush) for a method
+#
+#   IN:
+#   String method
+#   Int level (optional)
+#
+#   OUT:
+#   compressor
+#
+########################################################################################################################
+def make_compressor(method, level=None):
+
+    if level is None:
+        level = DEFAULT_COMPRESSION_LEVELS[method]
+    if method == "gzip":
+        # wbits 31 - gzip container, so the stored object is a regular .gz file
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    import zstandard
+    return zstandard.ZstdCompressor(level=level).compressobj()
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Returns a decompressor object (with decompress, eof and unused_data) for a method
+#
+#   IN:
+#   String method
+#
+#   OUT:
+#   decompressor
+#
+########################################################################################################################
+def make_decompressor(method):
+
+    if method == "gzip":
+        return zlib.decompressobj(31)
+
+    import zstandard
+    return zstandard.ZstdDecompressor().decompressobj()
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Writable file object that compresses everything written to it into a sink (e.g. an iRODS file handle)
+#
+#   IN:
+#   File-object sink
+#   String method
+#   Int level (optional)
+#   TransferDigest digest (optional, is updated with the compressed data as it is stored)
+#
+########################################################################################################################
+class CompressingWriter:
+    def __init__(self, sink, method, level=None, digest=None):
+        self.sink = sink
+        self.compressor = make_compressor(method, level)
+        self.digest = digest
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+
+    def write(self, chunk):
+        self.raw_bytes += len(chunk)
+        self.send(self.compressor.compress(chunk))
+        return len(chunk)
+
+    def send(self, data):
+        if data:
+            self.sink.write(data)
+            if self.digest is not None:
+                self.digest.update(data)
+            self.compressed_bytes += len(data)
+
+    # writes the end of the compressed stream - has to be called once after the last write
+    def finish(self):
+        self.send(self.compressor.flush())
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Readable file object that decompresses a compressed source (e.g. an iRODS file handle) while it is read.
+#   Concatenated gzip members and zstd frames are supported. Closing the reader closes the source.
+#
+#   IN:
+#   File-object source
+#   String method
+#   TransferDigest digest (optional, is updated with the compressed data as it is stored)
+#
+########################################################################################################################
+class DecompressingReader:
+    def __init__(self, source, method, digest=None):
+        self.source = source
+        self.method = method
+        self.digest = digest
+        self.decompressor = make_decompressor(method)
+        self.started = False
+        self.pending = memoryview(b"")
+        self.end = False
+        self.compressed_bytes = 0
+        self.raw_bytes = 0
+
+    def decompress(self, data):
+        output = []
+        while data:
+            self.started = True
+            output.append(self.decompressor.decompress(data))
+            if not getattr(self.decompressor, "eof", False):
+                break
+            # next gzip member or zstd frame
+            data = self.decompressor.unused_data
+            self.decompressor = make_decompressor(self.method)
+            self.started = False
+        return b"".join(output)
+
+    def readinto(self, buffer):
+        while not len(self.pending):
+            if self.end:
+                return 0
+            data = self.source.read(len(buffer))
+            if not data:
+                self.end = True
+                if self.started and not getattr(self.decompressor, "eof", True):
+                    raise Exception("Compressed data ends unexpectedly")
+                continue
+            self.compressed_bytes += len(data)
+            if self.digest is not None:
+                self.digest.update(data)
+            self.pending = memoryview(self.decompress(data))
+
+        read = min(len(buffer), len(self.pending))
+        buffer[:read] = self.pending[:read]
+        self.pending = self.pending[read:]
+        self.raw_bytes += read
+        return read
+
+    def close(self):
+        self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Formats the gain of a compressed transfer for the job output
+#
+#   IN:
+#   Int raw_bytes
+#   Int compressed_bytes
+#
+#   OUT:
+#   String summary
+#
+########################################################################################################################
+def format_compression(raw_bytes, compressed_bytes):
+
+    ratio = float(raw_bytes) / compressed_bytes if compressed_bytes else 1.0
+    return str(raw_bytes) + " -> " + str(compressed_bytes) + " bytes on the wire (ratio " + "%.2f" % ratio + ")"
+# -------------------------------------------------------------------------------------------------------------------- #
@@ -0,0 +1,130 @@
+# Line conversion of downloaded text files while they stream.
+#
+# Galaxy converts the line endings of uploaded text files to POSIX (and optionally runs of spaces to tabs) after the
+# upload, which reads and writes the whole file a second time. Downloads convert the chunks as they arrive instead,
+# with the same rules as Galaxy: CRLF and lone CR become LF, a missing newline at the end is added, and files with a
+# null byte in their first KiB (or in a compressed format) are binary and pass through unchanged.
+
+import re
+
+# bytes at the start of a file that decide between text and binary - the same amount Galaxy checks
+BINARY_CHECK_SIZE = 1024
+# magic numbers of compressed formats - Galaxy decompresses them before it converts anything
+COMPRESSED_MAGIC = (b"\x1f\x8b", b"BZh", b"PK\x03\x04", b"\xfd7zXZ\x00", b"\x28\xb5\x2f\xfd")
+
+# runs of blanks (whitespace except line breaks), replaced by a tab for space_to_tab
+BLANKS = re.compile(br"[^\S\r\n]+")
+TRAILING_BLANKS = re.compile(br"[^\S\r\n]+$")
+
+
+########################################################################################################################
+#   Decides if the start of a file is binary data
+#
+#   IN:
+#   Bytes head (the first BINARY_CHECK_SIZE bytes, or the whole file)
+#
+#   OUT:
+#   Bool binary
+#
+########################################################################################################################
+def is_binary_head(head):
+
+    return b"\0" in head[:BINARY_CHECK_SIZE] or head.startswith(COMPRESSED_MAGIC)
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Readable file object that converts a text source to POSIX line endings (and blanks to tabs) while it is read.
+#   CRLF pairs split between two chunks and runs of blanks split between two chunks are converted like unsplit ones.
+#   Binary sources are passed through unchanged - converted tells which of both happened.
+#
+#   IN:
+#   File-object source (has to support readinto)
+#   Bool space_to_tab
+#   TransferDigest digest (optional, is updated with the data as it is read from the source)
+#
+########################################################################################################################
+class PosixLinesReader:
+    def __init__(self, source, space_to_tab=False, digest=None):
+        self.source = source
+        self.space_to_tab = space_to_tab
+        self.digest = digest
+        self.chunk = None
+        self.head = b""
+        self.binary = None
+        self.last_cr = False
+        self.held = b""
+        self.last_byte = None
+        self.pending = memoryview(b"")
+        self.end = False
+
+    # True once the source turned out to be text
+    @property
+    def converted(self):
+        return self.binary is False
+
+    def convert(self, data, final):
+        # the LF of a CRLF pair whose CR ended the previous chunk
+        if self.last_cr and data.startswith(b"\n"):
+            data = data[1:]
+        self.last_cr = data.endswith(b"\r")
+        if b"\r" in data:
+            data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+        if self.space_to_tab:
+            data = self.held + data
+            self.held = b""
+            # blanks at the end of the chunk may continue in the next one
+            trailing = None if final else TRAILING_BLANKS.search(data)
+            if trailing is not None:
+                data, self.held = data[:trailing.start()], data[trailing.start():]
+            data = BLANKS.sub(b"\t", data)
+
+        if data:
+            self.last_byte = data[-1:]
+        if final and self.last_byte not in (None, b"\n"):
+            self.last_byte = b"\n"
+            data += b"\n"
+        return data
+
+    def readinto(self, buffer):
+        while not len(self.pending):
+            if self.end:
+                return 0
+
+            if self.chunk is None or len(self.chunk) < len(buffer):
+                self.chunk = bytearray(max(len(buffer), BINARY_CHECK_SIZE))
+            read = self.source.readinto(self.chunk)
+            data = bytes(self.chunk[:read])
+            if read and self.digest is not None:
+                self.digest.update(data)
+            if not read:
+                self.end = True
+
+            # the decision waits for the first KiB (or the end of a smaller file)
+            if self.binary is None:
+                self.head += data
+                if read and len(self.head) < BINARY_CHECK_SIZE:
+                    continue
+                self.binary = is_binary_head(self.head)
+                data, self.head = self.head, b""
+
+            if self.binary:
+                self.pending = memoryview(data)
+            else:
+                self.pending = memoryview(self.convert(data, self.end))
+
+        read = min(len(buffer), len(self.pending))
+        buffer[:read] = self.pending[:read]
+        self.pending = self.pending[read:]
+        return read
+
+    def close(self):
+        self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+# -------------------------------------------------------------------------------------------------------------------- #
@@ -0,0 +1,117 @@
+# Overlapped ingest of downloaded files into Galaxy.
+#
+# irods_upload.py is started once per job before the downloads and reads the datasets as JSON lines from its stdin,
+# so every downloaded file is sniffed, converted and moved into Galaxy while the next files are still downloading.
+# The upload process confirms every processed dataset on a separate pipe. Downloads wait for a free slot before they
+# start, so at most queue_size files are downloaded ahead of the ingest.
+
+import os
+import json
+import time
+import threading
+import subprocess
+
+# default number of files that are downloaded ahead of the ingest
+DEFAULT_INGEST_QUEUE = 4
+# environment variable with the file descriptor for the confirmations of irods_upload.py
+ACK_FD_VARIABLE = "IRODS_UPLOAD_ACK_FD"
+
+
+########################################################################################################################
+#   Upload process that ingests datasets while they are submitted
+#
+#   IN:
+#   List command (irods_upload.py with its arguments - the paramfile is "-")
+#   Int queue_size
+#
+########################################################################################################################
+class IngestPipeline:
+    def __init__(self, command, queue_size=DEFAULT_INGEST_QUEUE):
+        self.queue_size = max(1, queue_size)
+        self.pending = 0
+        self.submitted = 0
+        self.ingested = 0
+        # time.perf_counter() at the start and the seconds irods_upload.py spent on the datasets
+        self.started = time.perf_counter()
+        self.ingest_seconds = 0.0
+        self.failed = False
+        self.slots = threading.Condition()
+        self.writing = threading.Lock()
+
+        ack_read, ack_write = os.pipe()
+        try:
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, pass_fds=(ack_write,),
+                                            env=dict(os.environ, **{ACK_FD_VARIABLE: str(ack_write)}))
+        except Exception:
+            os.close(ack_read)
+            raise
+        finally:
+            os.close(ack_write)
+
+        self.acks = os.fdopen(ack_read, "rb")
+        self.reader = threading.Thread(target=self.read_acks)
+        self.reader.daemon = True
+        self.reader.start()
+
+    # frees a slot for every dataset the upload process confirms - with the seconds it took
+    def read_acks(self):
+        for line in self.acks:
+            try:
+                seconds = float(json.loads(line.decode("utf-8")).get("seconds", 0.0))
+            except (ValueError, AttributeError):
+                seconds = 0.0
+            with self.slots:
+                self.pending -= 1
+                self.ingested += 1
+                self.ingest_seconds += seconds
+                self.slots.notify_all()
+        # the upload process exited
+        with self.slots:
+            self.failed = True
+            self.slots.notify_all()
+
+    # waits until another file may be downloaded - every reserved slot is either submitted or released
+    def reserve(self):
+        with self.slots:
+            while self.pending >= self.queue_size and not self.failed:
+                self.slots.wait()
+            if self.failed:
+                raise Exception("Loading the downloaded files into Galaxy failed - upload process exited")
+            self.pending += 1
+
+    def release(self):
+        with self.slots:
+            self.pending -= 1
+            self.slots.notify_all()
+
+    # hands a downloaded file to the upload process - reserved=False for files that were downloaded without a slot
+    def submit(self, dataset, reserved=True):
+        line = (json.dumps(dataset) + "\n").encode("utf-8")
+        if not reserved:
+            with self.slots:
+                self.pending += 1
+
+        # the write may block on a full pipe, so it must not hold the slots - confirmations have to get through
+        with self.writing:
+            try:
+                self.process.stdin.write(line)
+                self.process.stdin.flush()
+                self.submitted += 1
+            except (BrokenPipeError, ValueError):
+                with self.slots:
+                    self.pending -= 1
+                    self.failed = True
+                    self.slots.notify_all()
+                raise Exception("Loading the downloaded files into Galaxy failed - upload process exited")
+
+    # waits for the remaining datasets and returns the exit code of the upload process
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        return_code = self.process.wait()
+        self.reader.join()
+        self.acks.close()
+        return return_code
+# -------------------------------------------------------------------------------------------------------------------- #
@@ -3,33 +3,54 @@ ___created___ = "04.02.2021"
 ___last_modified___ = "20.05.2021"
 
 # general imports
-import os, sys, json
+import os, sys, json, base64, subprocess, hashlib, socket, time, tempfile
 
-from shutil import copyfile
-from datetime import datetime
-from irods_data import registry_content
-
-# irods-client imports
-from irods.session import iRODSSession
-from irods.models import Collection, DataObject
-from irods.query import SpecificQuery
+# start of the module import - fallback for measuring the startup time
+import_started = time.perf_counter()
 
-# Tkinter imports
-from tkinter import messagebox, Label, Button, Entry, Listbox, Tk, PhotoImage, Grid
+from shutil import move, rmtree
+from datetime import datetime
+from irods_transfer import DEFAULT_BUFFER_SIZE, DEFAULT_MEMORY_LIMIT, DEFAULT_WORKERS, DEFAULT_PARALLEL_THRESHOLD, \
+    DEFAULT_PARALLEL_STREAMS, SessionPool, get_buffer_size, download_data_object, upload_data_object, send_file, \
+    transfer_concurrently, download_ranges, upload_ranges, TransferDigest, TransferJournal, PrefixRecorder
+from irods_cache import DEFAULT_CACHE_SIZE, DownloadCache
+from irods_broker import DEFAULT_BROKER_SOCKET, BrokerClient, BrokerPool, find_broker
+from irods_bundle import DEFAULT_BUNDLE_FILE_SIZE, DEFAULT_BUNDLE_MIN_FILES, DEFAULT_BUNDLE_MAX_SIZE, plan_bundles, \
+    write_bundle, extract_bundle, create_bundle, unpack_bundle
+from irods_compression import COMPRESSION_SUFFIXES, COMPRESSED_SUFFIXES, COMPRESSION_ATTRIBUTE, \
+    ORIGINAL_SIZE_ATTRIBUTE, CompressingWriter, DecompressingReader, get_compression, get_compression_of_name, \
+    format_compression
+from irods_convert import PosixLinesReader
+from irods_ingest import DEFAULT_INGEST_QUEUE, IngestPipeline
+from irods_metrics import DEFAULT_METRICS_FILE, TransferMetrics, format_metrics, write_metrics_file, \
+    update_prometheus_textfile
+from irods_retry import DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT, DEFAULT_RETRIES, DEFAULT_RETRY_DELAY, \
+    DEFAULT_RETRY_MAX_DELAY, DEFAULT_HEDGE_DELAY, RetryPolicy
+
+# irods-client and Tkinter modules are imported where they are used - jobs that talk to the connection broker never
+# load the irods-client and headless jobs never load Tkinter
+
+# per-user directory for files the tools keep between runs (file index, materialized registry)
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "galaxy_irods_interface")
+
+# directories that are never searched for Galaxy helper files (environments, data and caches)
+SKIPPED_SEARCH_DIRS = {".venv", "venv", ".git", "node_modules", "database", "tool-data", "_conda", "conda",
+                       "__pycache__", "client"}
 
 # global variables
 session = None
+broker_socket = None
 file_path_list = []
 selected_file = ""
 session_success = False
 selection_success = False
 iRODSCredentials = {"host": "", "port": "", "user": "", "pw": "", "zone": ""}
+iRODSTimeouts = {"connect": DEFAULT_CONNECT_TIMEOUT, "read": DEFAULT_READ_TIMEOUT}
+retry_policy = RetryPolicy()
+# timing and throughput of the run
+metrics = TransferMetrics()
 python_path = []
 
-with open("reg.xml", "w") as xf:
-    xf.write(registry_content)
-    xf.close()
-
 ########################################################################################################################
 #   Main function of the iRODS tools
 #
@@ -40,6 +61,8 @@ with open("reg.xml", "w") as xf:
 ########################################################################################################################
 def main():
 
+    print("iRODS tool startup: " + str(int(get_startup_time() * 1000)) + " ms")
+
     # check input parameters
     if len(sys.argv) == 2:
         params = json.loads(sys.argv[1])
@@ -79,16 +102,70 @@ def main():
     password = iRODSCredentials["pw"]
     zone = iRODSCredentials["zone"]
 
-    iRODSsession = get_iRODS_connection(host=host, port=port, user=user, password=password, zone=zone)
-    global session, session_success
+    # timeouts and retries of all iRODS calls
+    global iRODSTimeouts, retry_policy
+    iRODSTimeouts = get_timeouts(params)
+    retry_policy = get_retry_policy(params)
+
+    # timing and throughput of all phases - written when the run ends, also if it fails
+    global metrics
+    metrics = TransferMetrics("download" if is_download_call else "upload", params.get("job_id"))
+    metrics.add_phase("startup", get_startup_time())
     try:
-        coll = iRODSsession.collections.get("/" + zone + "/" + "home" + "/" + user)
-    except Exception:
-        raise Exception("Invalid Login")
+        run_tool(params, host, port, user, password, zone)
+        metrics.status = "ok"
+    finally:
+        write_metrics(params)
+# -------------------------------------------------------------------------------------------------------------------- #
 
-    if coll:
-        session = iRODSsession
+
+########################################################################################################################
+#   Logs into iRODS (or the connection broker) and runs the download or upload
+#
+#   IN:
+#   Dict params
+#   String host
+#   String port
+#   String user
+#   String password
+#   String zone
+#
+#   OUT:
+#
+########################################################################################################################
+def run_tool(params, host, port, user, password, zone):
+
+    global iRODSCredentials, selected_file
+
+    # use a running connection broker with warm sessions if there is one
+    global session, session_success, broker_socket
+    broker = None
+    if get_setting(params, "use_broker", True):
+        with metrics.phase("auth"):
+            broker = find_broker(get_setting(params, "broker_socket", DEFAULT_BROKER_SOCKET),
+                                 get_broker_credentials(params))
+
+    if broker is not None:
+        try:
+            with metrics.phase("auth"):
+                broker.request("login")
+        except Exception:
+            raise Exception("Invalid Login")
+        finally:
+            broker.close()
+        broker_socket = get_setting(params, "broker_socket", DEFAULT_BROKER_SOCKET)
         session_success = True
+    else:
+        iRODSsession = get_iRODS_connection(host=host, port=port, user=user, password=password, zone=zone)
+        try:
+            with metrics.phase("auth"):
+                coll = retry_policy.call(iRODSsession.collections.get, "/" + zone + "/" + "home" + "/" + user)
+        except Exception:
+            raise Exception("Invalid Login")
+
+        if coll:
+            session = iRODSsession
+            session_success = True
     
     
     # check tool settings and start tool execution
@@ -128,6 +205,8 @@ def main():
 ########################################################################################################################
 class LoginWindow:
     def __init__(self, win):
+        from tkinter import Label, Button, Entry, Grid
+
         self.window = win
         self.lbl1 = Label(win, text='iRODS Username:')
         self.lbl2 = Label(win, text='iRODS Password:')
@@ -150,6 +229,8 @@ class LoginWindow:
         self.b1.grid(row=4, column=0, padx="50", pady="10", sticky="nsew")
 
     def login(self):
+        from tkinter import messagebox
+
         global iRODSCredentials
         user = str(self.t1.get())
         password = str(self.t2.get())
@@ -181,6 +262,8 @@ class LoginWindow:
 ########################################################################################################################
 class FileSelectWindow:
     def __init__(self, win):
+        from tkinter import Button, Listbox, Grid
+
         global session, iRODSCredentials
         self.session = session
         self.window = win
@@ -195,22 +278,15 @@ class FileSelectWindow:
         self.lb1.grid(row=0, column=0, padx="20", pady="1", sticky="nswe")
         self.b1.grid(row=1, column=0, padx="50", pady="1", sticky="ew")
 
-        coll = session.collections.get("/" + iRODSCredentials["zone"] + "/" + "home" + "/" + iRODSCredentials["user"])
-        file_list = []
-
-        self.get_files_from_collections(coll, file_list)
+        home = "/" + iRODSCredentials["zone"] + "/" + "home" + "/" + iRODSCredentials["user"]
+        file_list = [file_entry["path"] for file_entry in list_iRODS_collection(session, home)]
 
         for counter in range(len(file_list)):
             self.lb1.insert(counter, file_list[counter])
 
-    def get_files_from_collections(self, coll, file_list):
-        for obj in coll.data_objects:
-            file_list.append(obj.path)
-
-        for col in coll.subcollections:
-            self.get_files_from_collections(col, file_list)
-
     def select(self):
+        from tkinter import messagebox
+
         global session, selected_file, selection_success
         try:
             selection = self.lb1.get(self.lb1.curselection())
@@ -236,6 +312,8 @@ class FileSelectWindow:
 #
 ########################################################################################################################
 def get_irods_session(window):
+    from tkinter import messagebox
+
     global iRODSCredentials
     host = iRODSCredentials["host"]
     port = iRODSCredentials["port"]
@@ -246,7 +324,7 @@ def get_irods_session(window):
     iRODSsession = get_iRODS_connection(host=host, port=port, user=user, password=password, zone=zone)
     global session, session_success
     try:
-        coll = iRODSsession.collections.get("/" + zone + "/" + "home" + "/" + user)
+        coll = retry_policy.call(iRODSsession.collections.get, "/" + zone + "/" + "home" + "/" + user)
     except Exception:
         window.iconify()
         messagebox.showerror("Error", "Invalid Authentification")
@@ -268,16 +346,10 @@ def get_irods_session(window):
 #
 ########################################################################################################################
 def make_login_window(params):
+    from tkinter import Tk, PhotoImage
+
     #get login icon
-    log_img = ""
-    for dirpath, dirnames, filenames in os.walk(params["galaxy_root"]):
-        for fn in filenames:
-            if fn == "irods_galaxy_login.png":
-                log_img = os.path.join(dirpath, fn)
-            if log_img != "":
-                break
-        if log_img != "":
-            break
+    log_img = find_galaxy_file(params["galaxy_root"], "irods_galaxy_login.png")
     # print(log_img)
     
     window = Tk()
@@ -302,6 +374,8 @@ def make_login_window(params):
 #
 ########################################################################################################################
 def make_file_select_window():
+    from tkinter import Tk
+
     window = Tk()
     FileSelectWindow(window)
     window.title('iRODS File Select')
@@ -311,6 +385,66 @@ def make_file_select_window():
 # -------------------------------------------------------------------------------------------------------------------- #
 
 
+########################################################################################################################
+#   Finds a helper file of the iRODS tools in the Galaxy installation. The tool's own directory and the usual tool
+#   locations are checked first. Otherwise Galaxy root is searched once and the result is stored in a small index
+#   file (per Galaxy root), so later runs don't have to search again.
+#
+#   IN:
+#   String galaxy_root
+#   String file_name
+#
+#   OUT:
+#   String file_path ("" if the file doesn't exist)
+#
+########################################################################################################################
+def find_galaxy_file(galaxy_root, file_name):
+
+    # tool directory and known tool locations
+    candidates = [os.path.dirname(os.path.abspath(__file__)),
+                  os.path.join(galaxy_root, "tools", "irods"),
+                  os.path.join(galaxy_root, "tools", "galaxy_irods_interface"),
+                  os.path.join(galaxy_root, "tools", "data_source")]
+    for candidate in candidates:
+        if os.path.isfile(os.path.join(candidate, file_name)):
+            return os.path.join(candidate, file_name)
+
+    # index of previous searches
+    index_file = os.path.join(CACHE_DIR, "file_index.json")
+    index = {}
+    try:
+        with open(index_file, "r") as fi:
+            index = json.load(fi)
+    except (OSError, ValueError):
+        pass
+
+    root_index = index.get(os.path.abspath(galaxy_root), {})
+    if os.path.isfile(root_index.get(file_name, "")):
+        return root_index[file_name]
+
+    # search Galaxy root - without descending into environments and data directories
+    file_path = ""
+    for dirpath, dirnames, filenames in os.walk(galaxy_root):
+        dirnames[:] = [dn for dn in dirnames if dn not in SKIPPED_SEARCH_DIRS]
+        if file_name in filenames:
+            file_path = os.path.join(dirpath, file_name)
+            break
+
+    if file_path != "":
+        root_index[file_name] = file_path
+        index[os.path.abspath(galaxy_root)] = root_index
+        try:
+            os.makedirs(os.path.dirname(index_file), exist_ok=True)
+            with open(index_file + "." + str(os.getpid()), "w") as fi:
+                json.dump(index, fi)
+            os.replace(index_file + "." + str(os.getpid()), index_file)
+        except OSError:
+            pass
+
+    return file_path
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
 ########################################################################################################################
 #   Checks whether arguments are valid and returns true/false depending on params
 #
@@ -345,6 +479,126 @@ def check_params(params):
 # -------------------------------------------------------------------------------------------------------------------- #
 
 
+########################################################################################################################
+#   Returns an optional tool setting - taken from params, or from the environment variable IRODS_GALAXY_<KEY>
+#   (e.g. set by the Galaxy admin in the job configuration), or the default value. The value is converted to the
+#   type of the default value.
+#
+#   IN:
+#   Dict params
+#   String key
+#   Object default
+#
+#   OUT:
+#   Object value
+#
+########################################################################################################################
+def get_setting(params, key, default):
+
+    value = params.get(key, "")
+    if value is None or value == "":
+        value = os.environ.get("IRODS_GALAXY_" + key.upper(), "")
+    if value is None or value == "":
+        return default
+
+    try:
+        if isinstance(default, bool):
+            return str(value).strip().lower() in ("1", "true", "yes", "on")
+        if isinstance(default, int):
+            return int(value)
+        if isinstance(default, float):
+            return float(value)
+    except ValueError:
+        raise Exception("Invalid value for setting " + key + ": " + str(value))
+
+    return value
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Returns the seconds since the start of the process - interpreter startup and all imports. Falls back to the time
+#   since the import of this module where /proc isn't available.
+#
+#   IN:
+#
+#   OUT:
+#   Float startup_time
+#
+########################################################################################################################
+def get_startup_time():
+
+    try:
+        with open("/proc/self/stat", "r") as sf:
+            # field 22 (starttime) - counted after the command name, which may contain spaces
+            start_ticks = float(sf.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime", "r") as uf:
+            uptime = float(uf.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return time.perf_counter() - import_started
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Returns the connect and read timeouts (seconds) of the iRODS sessions
+#
+#   IN:
+#   Dict params
+#
+#   OUT:
+#   Dict timeouts
+#
+########################################################################################################################
+def get_timeouts(params):
+
+    return {"connect": get_setting(params, "connect_timeout", float(DEFAULT_CONNECT_TIMEOUT)),
+            "read": get_setting(params, "read_timeout", float(DEFAULT_READ_TIMEOUT))}
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Returns the retry policy for catalog calls and transfer chunks
+#
+#   IN:
+#   Dict params
+#
+#   OUT:
+#   RetryPolicy policy
+#
+########################################################################################################################
+def get_retry_policy(params):
+
+    return RetryPolicy(get_setting(params, "retries", DEFAULT_RETRIES),
+                       get_setting(params, "retry_delay", DEFAULT_RETRY_DELAY),
+                       get_setting(params, "retry_max_delay", DEFAULT_RETRY_MAX_DELAY),
+                       get_setting(params, "hedge_delay", DEFAULT_HEDGE_DELAY))
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Prints the summary of the metrics of the run and writes them to metrics_file (JSON) and, if configured, to the
+#   Prometheus textfile metrics_textfile. Metrics that can't be written never fail the job.
+#
+#   IN:
+#   Dict params
+#
+#   OUT:
+#
+########################################################################################################################
+def write_metrics(params):
+
+    summary = metrics.to_dict(retry_policy)
+    print(format_metrics(summary))
+
+    try:
+        write_metrics_file(summary, get_setting(params, "metrics_file", DEFAULT_METRICS_FILE))
+        if get_setting(params, "metrics_textfile", "") != "":
+            update_prometheus_textfile(summary, get_setting(params, "metrics_textfile", ""))
+    except Exception as e:
+        print("Writing the transfer metrics failed: " + (str(e) or e.__class__.__name__))
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
 ########################################################################################################################
 #   Function to handle iRODS download calls
 #
@@ -356,24 +610,107 @@ def check_params(params):
 ########################################################################################################################
 def handle_download_call(params):
 
-    global session, selected_file
+    global session, selected_file, broker_socket
 
     # check if /ZONE/USER/...FILE... pattern is valid
     if len(selected_file.split("/")) < 2:
         raise Exception("Path to file is not valid in iRODS")
 
     file_list = []
+    coll_path = None
 
     # check if file is a directory
     if "." not in selected_file:
+        coll_path = selected_file.rstrip("/")
         try:
-            coll = session.collections.get(selected_file)
-            for file in coll.data_objects:
-                file_list.append(file.path)
+            with metrics.phase("catalog"):
+                if broker_socket is not None:
+                    broker = BrokerClient(broker_socket, get_broker_credentials(params))
+                    try:
+                        file_list = broker.request("list", path=coll_path,
+                                                   recursive=get_setting(params, "recursive_download", True))
+                    finally:
+                        broker.close()
+                else:
+                    file_list = retry_policy.call(list_iRODS_collection, session, coll_path,
+                                                  get_setting(params, "recursive_download", True))
+                    if not file_list:
+                        retry_policy.hedged(session.collections.get, coll_path)
         except:
             raise Exception("Invalid directory path specified!")
+
+        # files of subcollections get their relative path as name, so equal names can't collide
+        for file_entry in file_list:
+            file_entry["name"] = file_entry["path"][len(coll_path) + 1:].replace("/", "_")
     else:
-        file_list.append(selected_file)
+        file_list.append({"path": selected_file, "name": selected_file.split("/")[-1]})
+
+    # objects stored compressed are decompressed while they stream and lose their suffix locally - unless the name
+    # without the suffix is taken already
+    if get_setting(params, "decompress_downloads", False):
+        local_names = set(file_entry["name"] for file_entry in file_list)
+        for file_entry in file_list:
+            compression = get_compression_of_name(file_entry["path"])
+            if compression is None:
+                continue
+            name = file_entry["name"][:-len(COMPRESSION_SUFFIXES[compression])]
+            if name and name not in local_names:
+                local_names.add(name)
+                file_entry["name"] = name
+                file_entry["compression"] = compression
+
+    # text files get POSIX line endings (and tabs) while they download, instead of being rewritten by Galaxy afterwards
+    if get_setting(params, "convert_lines", True):
+        for file_entry in file_list:
+            file_entry["convert_lines"] = "posix_tabs" if get_setting(params, "space_to_tab", False) else "posix"
+
+    # the files are downloaded next to Galaxy's output file, so moving them into Galaxy is a rename on the same
+    # filesystem instead of a second copy
+    download_dir = get_download_dir(params)
+    for file_entry in file_list:
+        file_entry["name"] = os.path.join(download_dir, file_entry["name"])
+    try:
+        download_and_ingest(params, file_list, coll_path)
+    finally:
+        rmtree(download_dir, ignore_errors=True)
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Returns a new, empty directory for the downloaded files in the directory of the output file - or in the working
+#   directory if no file can be created there
+#
+#   IN:
+#   Dict params
+#
+#   OUT:
+#   String download_dir
+#
+########################################################################################################################
+def get_download_dir(params):
+
+    try:
+        return tempfile.mkdtemp(prefix="irods_download_", dir=os.path.dirname(os.path.abspath(params["out_file"])))
+    except (KeyError, OSError):
+        return tempfile.mkdtemp(prefix="irods_download_", dir=os.getcwd())
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Downloads the listed objects and loads them into Galaxy. Objects in a resource vault that is mounted on the Galaxy
+#   node are linked instead (link_to_files).
+#
+#   IN:
+#   Dict params
+#   List file_list (objects with their local file "name")
+#   String coll_path (None for a single object)
+#
+#   OUT:
+#
+########################################################################################################################
+def download_and_ingest(params, file_list, coll_path):
+
+    global session, broker_socket
 
     ## get registry file
     #reg_file = ""
@@ -385,102 +722,515 @@ def handle_download_call(params):
     #            break
     #    if reg_file != "":
     #        break
-    reg_file = "reg.xml"
-    
+
+    # number of parallel downloads - every download uses its own pooled iRODS session
+    workers = max(1, min(get_setting(params, "download_workers", DEFAULT_WORKERS), len(file_list)))
+
+    # size of the transfer buffers - all parallel downloads together stay below the configured memory limit
+    buffer_size = get_buffer_size(get_setting(params, "buffer_size", DEFAULT_BUFFER_SIZE),
+                                  get_setting(params, "memory_limit", DEFAULT_MEMORY_LIMIT), workers)
+
+    # objects in a mounted resource vault are linked into Galaxy without moving any data
+    vault_mounts = get_vault_mounts(params) if get_setting(params, "link_to_files", False) else []
+
+    if broker_socket is not None:
+        # the broker downloads with its warm sessions straight into the download directory
+        pool = BrokerPool(broker_socket, get_broker_credentials(params), workers)
+
+        def transfer(client, f):
+            if vault_mounts and not f.get("compression"):
+                vault_path = client.request("vault_path", file_entry=f, vault_mounts=vault_mounts)
+                if vault_path is not None:
+                    f["linked"] = True
+                    return vault_path
+            # the broker returns the file entry with what it learned while downloading
+            f.update(client.request("download", file_entry=f, params=params, buffer_size=buffer_size)["file_entry"])
+            return f["name"]
+
+        def transfer_bundle(client, bundle_files):
+            bundled_paths, _ = client.request("download_bundle", coll_path=coll_path, params=params,
+                                              file_list=bundle_files,
+                                              buffer_size=buffer_size)
+            bundled_paths = set(bundled_paths)
+            return [(f, f["name"]) for f in bundle_files if f["path"] in bundled_paths], \
+                [f for f in bundle_files if f["path"] not in bundled_paths]
+    else:
+        pool = SessionPool(get_pooled_iRODS_connection, workers, session)
+
+        # optional local cache shared by all jobs on this node
+        cache = None
+        if get_setting(params, "cache_dir", "") != "":
+            cache = DownloadCache(get_setting(params, "cache_dir", ""), get_setting(params, "cache_max_size",
+                                                                                     DEFAULT_CACHE_SIZE))
+
+        def transfer(pooled_session, f):
+            if vault_mounts and not f.get("compression"):
+                vault_path = get_vault_path(pooled_session, f, vault_mounts)
+                if vault_path is not None:
+                    f["linked"] = True
+                    return vault_path
+            return download_iRODS_file(pooled_session, f, params, buffer_size, cache)
+
+        def transfer_bundle(pooled_session, bundle_files):
+            bundled, missing = download_bundle(pooled_session, coll_path, bundle_files, params, buffer_size)
+            return [(f, f["name"]) for f in bundled], missing
+
     # print(file_list)
     # print(os.getcwd())
 
-    # handle download for all files in file_list
+    # every transfer is timed with the bytes it moved - linked files move none
+    transfer = metrics.measure("transfer", transfer,
+                               lambda f, name_file_to_get: 0 if f.get("linked") else os.path.getsize(name_file_to_get))
+    transfer_bundle = metrics.measure("bundle", transfer_bundle,
+                                      lambda bundle_files, result: sum(f["size"] for f, _ in result[0]))
+
+    # the upload process runs while the files download - every downloaded file is loaded into Galaxy right away, at
+    # most ingest_queue (but at least one per worker) files are downloaded ahead of it
+    pipeline = None
+    ingest_queue = get_setting(params, "ingest_queue", DEFAULT_INGEST_QUEUE)
+    if ingest_queue > 0:
+        pipeline = IngestPipeline(get_ingest_command(params, materialize_registry(), "-"), max(ingest_queue, workers))
+        ingest_order = {f["path"]: index for index, f in enumerate(file_list)}
+        download_file = transfer
+
+        # the start of every file is kept while it streams and passed on, so the upload process can sniff its
+        # datatype without reading the file again
+        if get_setting(params, "sniff_prefix", True):
+            for file_entry in file_list:
+                file_entry["keep_prefix"] = True
+
+        def transfer(pooled_session, f):
+            pipeline.reserve()
+            try:
+                name_file_to_get = download_file(pooled_session, f)
+            except Exception:
+                pipeline.release()
+                raise
+            pipeline.submit(get_dataset(params, f, name_file_to_get, ingest_order[f["path"]]))
+            f.pop("sniff_prefix", None)
+            return name_file_to_get
+
+    # collections with many small objects are fetched as one tar stream that iRODS packs on the server - the cache
+    # works per object, so it takes precedence, and tar members aren't decompressed or linked
+    downloaded_files = []
+    pending_files = file_list
+    if coll_path is not None and get_setting(params, "bundle_downloads", True) and not vault_mounts and \
+            get_setting(params, "cache_dir", "") == "" and not get_setting(params, "decompress_downloads", False):
+        small_files = [f for f in file_list if f["size"] <= get_setting(params, "bundle_file_size",
+                                                                        DEFAULT_BUNDLE_FILE_SIZE)]
+        if len(small_files) >= get_setting(params, "bundle_min_files", DEFAULT_BUNDLE_MIN_FILES):
+            bundle_results, bundle_failures = transfer_concurrently(pool, [file_list], transfer_bundle, 1)
+            for _, (bundled, missing) in bundle_results:
+                downloaded_files.extend(bundled)
+                if pipeline is not None:
+                    for file_entry, name_file_to_get in bundled:
+                        dataset = get_dataset(params, file_entry, name_file_to_get, ingest_order[file_entry["path"]])
+                        pipeline.submit(dataset, reserved=False)
+                # objects that weren't in the stream are fetched one by one
+                pending_files = missing
+            for _, error in bundle_failures:
+                print("Bundled download failed, downloading the files one by one: " + error)
+
+    # download all (remaining) files - a failing file doesn't stop the others
+    single_results, failed_files = transfer_concurrently(pool, pending_files, transfer, workers)
+    downloaded_files.extend(single_results)
+
+    # wait for the upload process, or load all downloaded files into Galaxy with a single upload process now
+    if pipeline is not None:
+        return_code = pipeline.close()
+        metrics.add_phase("ingest", pipeline.ingest_seconds, 0, pipeline.started)
+        if return_code != 0:
+            pool.cleanup()
+            raise Exception("Loading the downloaded files into Galaxy failed (exit code " + str(return_code) + ")")
+    elif downloaded_files:
+        with metrics.phase("ingest"):
+            ingest_datasets(params, [get_dataset(params, file_entry, name_file_to_get)
+                                     for file_entry, name_file_to_get in downloaded_files], materialize_registry())
+
+    # close connections
+    pool.cleanup()
+
+    # report all files that couldn't be downloaded
+    if failed_files:
+        summary = "Failed to download " + str(len(failed_files)) + " of " + str(len(file_list)) + " files:"
+        for file_entry, error in failed_files:
+            summary += "\n  " + file_entry["path"] + ": " + error
+        raise Exception(summary)
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Downloads the objects of a collection as one tar stream. iRODS packs the collection into a temporary tar data
+#   object, which is unpacked into the local files while it streams. Objects that are missing in the stream, are
+#   incomplete or fail the checksum verification are returned, so they can be downloaded one by one.
+#
+#   IN:
+#   iRODSSession-object session
+#   String coll_path
+#   List file_list (listed objects of the collection with their local "name")
+#   Dict params
+#   Int buffer_size
+#
+#   OUT:
+#   List bundled_files
+#   List missing_files
+#
+########################################################################################################################
+def download_bundle(session, coll_path, file_list, params, buffer_size):
+
+    # the tar object lives outside of the bundled collection
+    bundle_coll = "/" + params["irods_zone"] + "/home/" + params["irods_user"] + "/.galaxy_bundles"
+    try:
+        retry_policy.hedged(session.collections.get, bundle_coll)
+    except Exception:
+        session.collections.create(bundle_coll)
+    tar_path = bundle_coll + "/" + hashlib.sha256((coll_path + "\0" + str(os.getpid()) + "\0" +
+                                                  str(datetime.now())).encode("utf-8")).hexdigest()[:16] + ".tar"
+
+    verify = get_setting(params, "verify_checksum", False)
+    members = {}
+    for f in file_list:
+        digest = TransferDigest(f["checksum"]) if verify and f.get("checksum") else None
+        members[f["path"][len(coll_path) + 1:]] = (f["name"], digest)
+
+    received = {}
+    try:
+        create_bundle(session, tar_path, coll_path, get_setting(params, "bundle_resource", ""))
+        with session.data_objects.open(tar_path, "r") as irods_file:
+            unpack_bundle(irods_file, members, buffer_size, received)
+    except Exception as e:
+        # objects unpacked before the error are kept
+        if not received:
+            raise
+        print("Bundled download of " + coll_path + " stopped early: " + (str(e) or e.__class__.__name__))
+    finally:
+        try:
+            session.data_objects.unlink(tar_path, force=True)
+        except Exception:
+            pass
+
+    bundled_files = []
+    missing_files = []
     for f in file_list:
+        name, digest = members[f["path"][len(coll_path) + 1:]]
+        if received.get(f["path"][len(coll_path) + 1:]) == f["size"] and \
+                (digest is None or digest.matches(f["checksum"])):
+            bundled_files.append(f)
+        else:
+            if check_if_file_exists(name):
+                os.remove(name)
+            missing_files.append(f)
+
+    return bundled_files, missing_files
+# -------------------------------------------------------------------------------------------------------------------- #
+
 
-        file_to_get = f
-
-        # handle path and file name
-        name_file_to_get = file_to_get.split("/")[-1]
-        path_file_to_get = "/".join(file_to_get.split("/")[0:len(file_to_get.split("/")) - 1])
-
-        # check iRODS filesystem
-        check_iRODS_destination(session, path_file_to_get, name_file_to_get)
-
-        # get file object from iRODS
-        iRODS_file_object = session.data_objects.get(path_file_to_get + "/" + name_file_to_get)
-        input_file = iRODS_file_object.open("r+")
-        output_file = open(name_file_to_get, "wb")
-        output_file.write(input_file.read())
-        #input_file.seek(0,0)
-        #print(input_file.read().decode("utf-8"))
-        #temp = open("/home/richard/test.txt", "w")
-        #input_file.seek(0,0)
-        #temp.write(input_file.read().decode("utf-8"))
-	
-        input_file.close()
-        output_file.close()
-
-        abs_file_path = os.path.abspath(name_file_to_get)
-
-        file_type = str(name_file_to_get.split(".")[-1])
-
-        file_content = {"uuid": None,
-                        "file_type": "auto",
-                        "space_to_tab": False,
-                        "dbkey": "?",
-                        "to_posix_lines": True,
-                        "ext": file_type,
-                        "path": abs_file_path,
-                        "in_place": True,
-                        "dataset_id": params["job_id"],
-                        "type": "file",
-                        "is_binary": False,
-                        "link_data_only": "copy_files",
-                        "name": name_file_to_get
-                        }
-
-        with open("temporal.json", "w") as fileParams:
-            fileParams.write(json.dumps(file_content))
-        fileParams.close()
-
-        # load file into Galaxy by using the integrated upload tool - Preparation
-        python_command = params["galaxy_root"] + "/tools/data_source/upload.py"
-        arg1 = params["galaxy_root"]
-        arg2 = params["galaxy_datatypes"]
-        arg3 = os.path.abspath(fileParams.name)
-        arg4 = params["job_id"] + ":" + params["out_dir"] + ":" + params["out_file"]
-        arg5 = params["galaxy_root"] + "/lib/galaxy"
-
-        # copy sample registry.xml to working directory
-        copyfile(reg_file, params["galaxy_datatypes"])
-
-        # activate environment for new process call and call the python upload command either both with
-        #sys.path.append(params["galaxy_root"] + "/lib")
-        #os.system("python -c \'import sys;sys.path.append(\"" + params["galaxy_root"] + "/lib\")\'" + "&& python3 " +
-        #          python_command + " " + arg1 + " " + arg2 + " " + arg3 + " " + arg4)
-        
-        # get upload file
-        upload_file = ""
-        for dirpath, dirnames, filenames in os.walk(params["galaxy_root"]):
-            for fn in filenames:
-                if fn == "irods_upload.py":
-                    upload_file = os.path.join(dirpath, fn)
-                if upload_file != "":
-                    break
-            if upload_file != "":
-                break
+########################################################################################################################
+#   Returns the Galaxy upload parameters of a downloaded or linked file
+#
+#   IN:
+#   Dict params
+#   Dict file_entry
+#   String name_file_to_get (local file)
+#   Int ingest_order (optional, position of the file in the job - for datasets that are streamed to the upload process)
+#
+#   OUT:
+#   Dict file_content
+#
+########################################################################################################################
+def get_dataset(params, file_entry, name_file_to_get, ingest_order=None):
+
+    abs_file_path = os.path.abspath(name_file_to_get)
+
+    # linked files keep the name of the vault file - the dataset is named after the object
+    name = os.path.basename(file_entry["name"])
+    file_type = str(name.split(".")[-1])
+
+    file_content = {"uuid": None,
+                    "file_type": "auto",
+                    "space_to_tab": get_setting(params, "space_to_tab", False),
+                    "dbkey": "?",
+                    "to_posix_lines": True,
+                    "ext": file_type,
+                    "path": abs_file_path,
+                    "in_place": False,
+                    "dataset_id": params["job_id"],
+                    "type": "file",
+                    "is_binary": False,
+                    "link_data_only": "copy_files",
+                    "name": name
+                    }
+    # downloaded files belong to the job and are moved into Galaxy - the file in the vault belongs to iRODS, it is
+    # linked as it is and never converted or removed
+    if file_entry.get("linked") or file_entry.get("converted"):
+        file_content["to_posix_lines"] = False
+        file_content["space_to_tab"] = False
+    if file_entry.get("linked"):
+        file_content["in_place"] = True
+        file_content["link_data_only"] = "link_to_files"
+        file_content["auto_decompress"] = False
+    # the file was decompressed while it streamed - Galaxy doesn't have to look for compression again
+    if file_entry.get("compression"):
+        file_content["auto_decompress"] = False
+    if ingest_order is not None:
+        file_content["ingest_order"] = ingest_order
+    if file_entry.get("sniff_prefix"):
+        file_content["sniff_prefix"] = file_entry["sniff_prefix"]
+
+    return file_content
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Function to load downloaded files into Galaxy. All datasets are written into one paramfile and processed by a
+#   single run of irods_upload.py, so the Galaxy datatypes registry is only loaded once per job.
+#
+#   IN:
+#   Dict params
+#   List datasets (Galaxy upload parameters of each file)
+#   String reg_file (datatypes config for the upload tool)
+#
+#   OUT:
+#
+########################################################################################################################
+def ingest_datasets(params, datasets, reg_file):
+
+    with open("temporal.json", "w") as fileParams:
+        fileParams.write(json.dumps(datasets))
+
+    # run the upload tool once with Galaxy's python environment
+    return_code = subprocess.call(get_ingest_command(params, reg_file, os.path.abspath(fileParams.name)))
+    if return_code != 0:
+        raise Exception("Loading the downloaded files into Galaxy failed (exit code " + str(return_code) + ")")
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Returns the command line of irods_upload.py with Galaxy's python environment
+#
+#   IN:
+#   Dict params
+#   String reg_file (datatypes config for the upload tool)
+#   String param_file (paramfile with the datasets, "-" for datasets streamed on stdin)
+#
+#   OUT:
+#   List command
+#
+########################################################################################################################
+def get_ingest_command(params, reg_file, param_file):
+
+    # load files into Galaxy by using the integrated upload tool - Preparation
+    arg1 = params["galaxy_root"]
+    arg2 = reg_file
+    arg3 = param_file
+    arg4 = params["job_id"] + ":" + params["out_dir"] + ":" + params["out_file"]
+
+    # get upload file
+    upload_file = find_galaxy_file(params["galaxy_root"], "irods_upload.py")
+    if upload_file == "":
+        raise Exception("irods_upload.py not found in Galaxy root " + params["galaxy_root"])
+
+    # make the Galaxy libraries available to the upload process
+    if params["galaxy_root"] + "/lib" not in sys.path:
         sys.path.append(params["galaxy_root"] + "/lib")
-        #sys.path.append(params["galaxy_root"] + "/tools/data_source")
-        #sys.path.append(params["galaxy_root"] + "/.venv/lib/python3.8/site-packages")
-        with open("python__path.txt", "w") as pp:
-            pp.truncate(0)
-            for item in sys.path:
-                pp.write(item + ",")
+    with open("python__path.txt", "w") as pp:
+        for item in sys.path:
+            pp.write(item + ",")
+
+    return [params["galaxy_root"] + "/.venv/bin/python", upload_file, arg1, arg2, arg3, arg4]
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Writes the sample datatypes registry of the tools to a content-addressed file below CACHE_DIR. The file name is
+#   the sha256 of the content, so an existing file is only rewritten if its content doesn't match its name. The file
+#   is written to a temporary name and renamed, so parallel jobs never see a partially written registry.
+#
+#   IN:
+#   String cache_dir
+#
+#   OUT:
+#   String reg_file
+#
+########################################################################################################################
+def materialize_registry(cache_dir=CACHE_DIR):
+    from irods_data import registry_content
+
+    content = registry_content.encode("utf-8")
+    content_hash = hashlib.sha256(content).hexdigest()
+    reg_dir = os.path.join(cache_dir, "registry")
+    reg_file = os.path.join(reg_dir, content_hash + ".xml")
+
+    try:
+        with open(reg_file, "rb") as rf:
+            if hashlib.sha256(rf.read()).hexdigest() == content_hash:
+                return reg_file
+    except OSError:
+        pass
+
+    os.makedirs(reg_dir, exist_ok=True)
+    tmp_file = reg_file + "." + str(os.getpid()) + ".tmp"
+    with open(tmp_file, "wb") as rf:
+        rf.write(content)
+    os.replace(tmp_file, reg_file)
+
+    return reg_file
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Downloads a single iRODS file into the working directory
+#
+#   IN:
+#   iRODSSession-object session
+#   Dict file_entry (iRODS "path" and local "name" of the file)
+#   Dict params
+#   Int buffer_size
+#   DownloadCache cache (optional)
+#
+#   OUT:
+#   String name_file_to_get
+#
+########################################################################################################################
+def download_iRODS_file(session, file_entry, params, buffer_size, cache=None):
+
+    # handle path and file name
+    file_to_get = file_entry["path"]
+    path_file_to_get = "/".join(file_to_get.split("/")[0:len(file_to_get.split("/")) - 1])
+    name_file_to_get = file_entry["name"]
+
+    # check iRODS filesystem and get the object metadata - unless the collection listing already provided it
+    if "size" not in file_entry:
+        iRODS_file_object = check_iRODS_destination(session, path_file_to_get, file_to_get.split("/")[-1])
+        file_entry["size"] = iRODS_file_object.size
+        file_entry["checksum"] = iRODS_file_object.checksum
+        file_entry["modify_time"] = iRODS_file_object.modify_time
+
+    # open the data object by its path - no further catalog lookups before the transfer
+    def open_object(mode):
+        return session.data_objects.open(file_to_get, mode)
+
+    # the start of the object is kept in memory for the sniffer of the upload process
+    recorder = PrefixRecorder() if file_entry.get("keep_prefix") else None
+
+    def open_recorded(mode):
+        if recorder is None:
+            return open_object(mode)
+        return recorder.record(open_object(mode))
+
+    # stream the object to disk chunk by chunk
+    streams = get_setting(params, "parallel_streams", DEFAULT_PARALLEL_STREAMS)
+
+    # the checksum is computed from the streamed chunks - parallel byte ranges arrive out of order and can't be
+    # verified without reading the file again, so verified objects are always downloaded with a single stream
+    verify = get_setting(params, "verify_checksum", False) and bool(file_entry.get("checksum"))
+    if verify:
+        streams = 1
+
+    # compressed objects are decompressed in one stream from start to end - no ranges or resumption
+    compression = file_entry.get("compression")
+    if compression is not None:
+        streams = 1
+
+    # resumable downloads keep the partial file and its journal in resume_dir, so a rerun can continue them
+    resume_dir = get_setting(params, "resume_dir", "")
+
+    # large objects are split into byte ranges which are downloaded in parallel
+    ranged = streams > 1 and file_entry["size"] >= get_setting(params, "parallel_threshold", DEFAULT_PARALLEL_THRESHOLD)
+
+    # text files are converted to POSIX lines while they stream - not with byte ranges or resumption, which need the
+    # positions in the local file to match the object
+    convert_lines = None
+    if not ranged and (resume_dir == "" or compression is not None):
+        convert_lines = file_entry.get("convert_lines")
+
+    def download(target_path):
+        journal = None
+        work_path = target_path
+        if compression is not None or convert_lines is not None:
+            # a failed attempt starts over - the local file can't be mapped back to a position in the object
+            def attempt():
+                digest = TransferDigest(file_entry["checksum"]) if verify else None
+                readers = {}
+
+                # the checksum of the stored object is computed from the data as it comes from iRODS
+                def open_streamed(mode):
+                    handle = open_object(mode)
+                    if compression is not None:
+                        handle = readers["decompress"] = DecompressingReader(handle, compression, digest)
+                    if convert_lines is not None:
+                        handle = readers["convert"] = PosixLinesReader(handle, convert_lines == "posix_tabs",
+                                                                       digest if compression is None else None)
+                    return handle if recorder is None else recorder.record(handle)
+
+                download_data_object(open_streamed, target_path, buffer_size)
+                if verify and not digest.matches(file_entry["checksum"]):
+                    raise Exception("Checksum mismatch: iRODS has " + file_entry["checksum"] +
+                                    ", the downloaded data has " + digest.get_irods_checksum(file_entry["checksum"]))
+                return readers
+
+            readers = retry_policy.call(attempt)
+            if "decompress" in readers:
+                print("Decompressed " + file_to_get + ": " + format_compression(readers["decompress"].raw_bytes,
+                                                                                 readers["decompress"].compressed_bytes))
+            # binary files pass the conversion unchanged
+            if "convert" in readers and readers["convert"].converted:
+                file_entry["converted"] = True
+            return
 
-        os.system(params["galaxy_root"] + "/.venv/bin/python " +  upload_file + " " + arg1 + " " + arg2 + " " + arg3 + " " + arg4)
-    # close connection
-    session.cleanup()
+        if resume_dir != "":
+            os.makedirs(resume_dir, exist_ok=True)
+            work_path = os.path.join(resume_dir, hashlib.sha256(file_to_get.encode("utf-8")).hexdigest() + ".part")
+            journal = TransferJournal(work_path + ".journal", {"path": file_to_get,
+                                                               "size": file_entry["size"],
+                                                               "checksum": file_entry.get("checksum"),
+                                                               "modify_time": file_entry.get("modify_time")})
+
+        if ranged:
+            # the streams share the buffer
+            download_ranges(open_recorded, work_path, file_entry["size"], streams, max(1, buffer_size // streams),
+                            journal, retry_policy)
+        else:
+            digest = TransferDigest(file_entry["checksum"]) if verify else None
+            download_data_object(open_recorded, work_path, buffer_size, digest, journal, retry_policy)
+            if verify and not digest.matches(file_entry["checksum"]):
+                # a corrupt partial file must not be resumed
+                if journal is not None:
+                    journal.remove()
+                    os.remove(work_path)
+                raise Exception("Checksum mismatch: iRODS has " + file_entry["checksum"] + ", the downloaded data has " +
+                                digest.get_irods_checksum(file_entry["checksum"]))
+
+        if journal is not None:
+            move(work_path, target_path)
+            journal.remove()
+
+    try:
+        if cache is not None:
+            # serve the file from the local cache - only transferred if nobody downloaded it before
+            if cache.fetch(file_entry, name_file_to_get, download):
+                print("Served from cache: " + file_to_get)
+        else:
+            download(name_file_to_get)
+    except Exception:
+        # never leave a partial file behind
+        if check_if_file_exists(name_file_to_get):
+            os.remove(name_file_to_get)
+        raise
+
+    # only a complete prefix is passed on - e.g. not for resumed downloads or files served from the cache
+    if recorder is not None:
+        prefix = recorder.get_prefix(os.path.getsize(name_file_to_get))
+        if prefix is not None:
+            file_entry["sniff_prefix"] = base64.b64encode(prefix).decode("ascii")
+
+    return name_file_to_get
 # -------------------------------------------------------------------------------------------------------------------- #
 
 
 ########################################################################################################################
-#   Function to handle iRODS upload calls
+#   Function to handle iRODS upload calls. All datasets of the job (a multiple-data param or the elements of a list
+#   collection) are uploaded concurrently over pooled sessions into one target collection.
 #
 #   IN:
 #   Dict params
@@ -490,54 +1240,362 @@ def handle_download_call(params):
 ########################################################################################################################
 def handle_upload_call(params):
 
-    global session, iRODSCredentials
+    global session, broker_socket
+
+    # older tool versions pass a single dataset
+    up_files = params.get("up_files") or [{"name": params["up_file"], "path": params["up_file_path"]}]
+    #print(up_files)
+
+    # names have to be unique within the job - elements of different collections may share an identifier
+    file_list = []
+    used_names = set()
+    for up_file in up_files:
+        name_of_file = str(up_file["name"]).split("/")[-1]
+        stem, extension = os.path.splitext(name_of_file)
+        counter = 1
+        while name_of_file in used_names:
+            name_of_file = stem + "_" + str(counter) + extension
+            counter += 1
+        used_names.add(name_of_file)
+        file_list.append({"path": up_file["path"], "name": name_of_file, "size": os.path.getsize(up_file["path"])})
+
+    # number of parallel uploads - every upload uses its own pooled iRODS session
+    workers = max(1, min(get_setting(params, "upload_workers", DEFAULT_WORKERS), len(file_list)))
+
+    # size of the transfer buffers - all parallel uploads together stay below the configured memory limit
+    buffer_size = get_buffer_size(get_setting(params, "buffer_size", DEFAULT_BUFFER_SIZE),
+                                  get_setting(params, "memory_limit", DEFAULT_MEMORY_LIMIT), workers)
+
+    # the target collection is resolved (or created) once for all datasets
+    if broker_socket is not None:
+        # the broker uploads with its warm sessions
+        pool = BrokerPool(broker_socket, get_broker_credentials(params), workers)
+        with pool.session() as client, metrics.phase("catalog"):
+            coll_path = client.request("upload_collection", params=params)
+
+        def transfer(client, f):
+            return client.request("upload", local_path=os.path.abspath(f["path"]), name=f["name"], params=params,
+                                  coll_path=coll_path, buffer_size=buffer_size)
+
+        def transfer_bundle(client, bundle):
+            return client.request("upload_bundle", file_list=[dict(f, path=os.path.abspath(f["path"])) for f in bundle],
+                                  params=params, coll_path=coll_path, buffer_size=buffer_size)
+    else:
+        with metrics.phase("catalog"):
+            coll_path = get_upload_collection(session, params)
+        pool = SessionPool(get_pooled_iRODS_connection, workers, session)
+
+        def transfer(pooled_session, f):
+            return upload_iRODS_file(pooled_session, f["path"], f["name"], params, coll_path, buffer_size)
+
+        def transfer_bundle(pooled_session, bundle):
+            return upload_bundle(pooled_session, bundle, params, coll_path, buffer_size)
+
+    # every transfer is timed with the bytes it moved
+    transfer = metrics.measure("transfer", transfer, lambda f, irods_file_name: f["size"])
+    transfer_bundle = metrics.measure("bundle", transfer_bundle,
+                                      lambda bundle, result: sum(f["size"] for f, _ in result[0]))
+
+    # many small files are packed into tar bundles which iRODS extracts into the target collection - checksums are
+    # computed while sending single files, so verified uploads are never bundled
+    bundles = []
+    single_files = file_list
+    if get_setting(params, "bundle_uploads", True) and not get_setting(params, "verify_checksum", False) and \
+            get_compression(get_setting(params, "compression", "")) is None:
+        bundles, single_files = plan_bundles(file_list,
+                                             get_setting(params, "bundle_min_files", DEFAULT_BUNDLE_MIN_FILES),
+                                             get_setting(params, "bundle_file_size", DEFAULT_BUNDLE_FILE_SIZE),
+                                             get_setting(params, "bundle_max_size", DEFAULT_BUNDLE_MAX_SIZE))
+
+    uploaded_files = []
+    if bundles:
+        bundle_results, failed_bundles = transfer_concurrently(pool, bundles, transfer_bundle, workers)
+        for bundle, (bundled_files, missing_files) in bundle_results:
+            uploaded_files.extend((f, irods_file_name) for f, irods_file_name in bundled_files)
+            single_files = single_files + missing_files
+        # files of bundles that couldn't be extracted are sent one by one
+        for bundle, error in failed_bundles:
+            print("Bundled upload failed, uploading " + str(len(bundle)) + " files one by one: " + error)
+            single_files = single_files + bundle
+
+    # upload all other files - a failing file doesn't stop the others
+    single_results, failed_files = transfer_concurrently(pool, single_files, transfer, workers)
+    uploaded_files.extend(single_results)
+
+    # close connections
+    pool.cleanup()
+
+    for file_entry, irods_file_name in uploaded_files:
+        print("Successfully uploaded: " + file_entry["name"] + "\n as: " + irods_file_name)
+
+    # report all files that couldn't be uploaded
+    if failed_files:
+        summary = "Failed to upload " + str(len(failed_files)) + " of " + str(len(file_list)) + " files:"
+        for file_entry, error in failed_files:
+            summary += "\n  " + file_entry["name"] + ": " + error
+        raise Exception(summary)
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Uploads a bundle of small files as one tar data object and lets iRODS extract it into the target collection. The
+#   extracted objects are checked with one listing of the collection - files that are missing or incomplete are
+#   returned, so they can be uploaded one by one.
+#
+#   IN:
+#   iRODSSession-object session
+#   List bundle (dicts with "path", "name" and "size" of each file)
+#   Dict params
+#   String coll_path
+#   Int buffer_size
+#
+#   OUT:
+#   List bundled_files (list of (file, irods_file_name))
+#   List missing_files
+#
+########################################################################################################################
+def upload_bundle(session, bundle, params, coll_path, buffer_size):
 
-    path_to_file = params["up_file_path"]
-    name_of_file = params["up_file"]
-    #print(path_to_file)
-    #print(name_of_file)
+    time = datetime.now().strftime("%H%M%S")
+    members = [(f["path"], time + "_" + f["name"]) for f in bundle]
+    tar_path = coll_path + "/.galaxy_bundle_" + time + "_" + hashlib.sha256(
+        "\0".join(member_name for _, member_name in members).encode("utf-8")).hexdigest()[:16] + ".tar"
 
-    coll_path = "/" + iRODSCredentials["zone"] + "/home/" + iRODSCredentials["user"] + "/galaxyupload"
+    # the tar stream goes directly into iRODS - no local archive is written
+    extract_error = None
+    session.data_objects.create(tar_path)
     try:
-        coll = session.collections.get(coll_path)
-    except:
-        coll = session.collections.create(coll_path)
+        with session.data_objects.open(tar_path, "w") as irods_file:
+            write_bundle(irods_file, members, buffer_size)
+        try:
+            extract_bundle(session, tar_path, coll_path, get_setting(params, "bundle_resource", ""))
+        except Exception as e:
+            # members that were extracted before the error are kept - only the others are sent again
+            extract_error = e
+    finally:
+        try:
+            session.data_objects.unlink(tar_path, force=True)
+        except Exception:
+            pass
+
+    listed = {file_entry["name"]: file_entry["size"]
+              for file_entry in retry_policy.call(list_iRODS_collection, session, coll_path, False)}
+
+    bundled_files = []
+    missing_files = []
+    for f, (_, member_name) in zip(bundle, members):
+        if listed.get(member_name) == f["size"]:
+            bundled_files.append((f, member_name))
+        else:
+            missing_files.append(f)
 
-    now = datetime.now()
+    if extract_error is not None and not bundled_files:
+        raise extract_error
 
-    # dd/mm/YY
-    day = now.strftime("%d%m%Y")
-    time = now.strftime("%H%M%S")
+    return bundled_files, missing_files
+# -------------------------------------------------------------------------------------------------------------------- #
 
-    coll_path = coll_path + "/" + day
+
+########################################################################################################################
+#   Returns the galaxyupload/<date> collection of the user and creates it if it doesn't exist yet. The collection of
+#   the day usually exists already, so it is looked up first.
+#
+#   IN:
+#   iRODSSession-object session
+#   Dict params
+#
+#   OUT:
+#   String coll_path
+#
+########################################################################################################################
+def get_upload_collection(session, params):
+
+    upload_path = "/" + params["irods_zone"] + "/home/" + params["irods_user"] + "/galaxyupload"
+
+    # dd/mm/YY
+    coll_path = upload_path + "/" + datetime.now().strftime("%d%m%Y")
 
     try:
-        coll = session.collections.get(coll_path)
-    except:
-        coll = session.collections.create(coll_path)
+        retry_policy.hedged(session.collections.get, coll_path)
+        return coll_path
+    except Exception:
+        pass
+
+    for path in (upload_path, coll_path):
+        try:
+            retry_policy.hedged(session.collections.get, path)
+        except Exception:
+            try:
+                session.collections.create(path)
+            except Exception:
+                # a parallel job may have created it in the meantime
+                retry_policy.hedged(session.collections.get, path)
+
+    return coll_path
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Uploads a single Galaxy file into the galaxyupload/<date> collection of the user
+#
+#   IN:
+#   iRODSSession-object session
+#   String path_to_file
+#   String name_of_file
+#   Dict params
+#   String coll_path (optional, target collection - resolved with get_upload_collection if missing)
+#   Int buffer_size (optional)
+#
+#   OUT:
+#   String irods_file_name
+#
+########################################################################################################################
+def upload_iRODS_file(session, path_to_file, name_of_file, params, coll_path=None, buffer_size=None):
+
+    if coll_path is None:
+        coll_path = get_upload_collection(session, params)
+
+    time = datetime.now().strftime("%H%M%S")
     
     if "/" in name_of_file:
         name_of_file = name_of_file.split("/")[-1]
-    
-    irods_file_name = time + "_" + name_of_file
-    iRODS_file_object = session.data_objects.create(coll_path + "/" + irods_file_name)
-    iRODS_file_object = session.data_objects.get(coll_path + "/" + irods_file_name)
 
-    irods_file = iRODS_file_object.open("w")
-    galaxy_file = open(path_to_file, "rb")
-    content = galaxy_file.read()
-    irods_file.write(content)
+    # compressed while streaming - files that are compressed already are sent as they are
+    compression = get_compression(get_setting(params, "compression", ""))
+    if name_of_file.lower().endswith(COMPRESSED_SUFFIXES):
+        compression = None
+
+    # resumable uploads - a journal in resume_dir remembers the target object and the committed offset
+    journal = None
+    resume_dir = get_setting(params, "resume_dir", "")
+    if resume_dir != "" and compression is None:
+        os.makedirs(resume_dir, exist_ok=True)
+        file_stat = os.stat(path_to_file)
+        journal_name = hashlib.sha256(os.path.abspath(path_to_file).encode("utf-8")).hexdigest() + ".upload.journal"
+        journal = TransferJournal(os.path.join(resume_dir, journal_name), {"path": os.path.abspath(path_to_file),
+                                                                          "size": file_stat.st_size,
+                                                                          "modify_time": file_stat.st_mtime,
+                                                                          "user": params["irods_user"],
+                                                                          "zone": params["irods_zone"]})
+        journal.load()
+
+    iRODS_file_object = None
+    if journal is not None and journal.progress.get("target"):
+        # continue the interrupted upload into the same data object
+        try:
+            iRODS_file_object = retry_policy.hedged(session.data_objects.get, journal.progress["target"])
+            coll_path, irods_file_name = iRODS_file_object.path.rsplit("/", 1)
+        except Exception:
+            journal.progress = {}
+
+    if iRODS_file_object is None:
+        irods_file_name = time + "_" + name_of_file
+        if compression is not None:
+            irods_file_name += COMPRESSION_SUFFIXES[compression]
+        iRODS_file_object = session.data_objects.create(coll_path + "/" + irods_file_name)
+        if journal is not None:
+            journal.save("target", iRODS_file_object.path)
+
+    def open_object(mode):
+        return session.data_objects.open(iRODS_file_object.path, mode)
+
+    # size of the transfer buffer - bounded by the configured memory limit
+    if buffer_size is None:
+        buffer_size = get_buffer_size(get_setting(params, "buffer_size", DEFAULT_BUFFER_SIZE),
+                                      get_setting(params, "memory_limit", DEFAULT_MEMORY_LIMIT))
+
+    # with checksum verification the checksum is computed from the streamed chunks, which needs a single stream
+    digest = None
+    if get_setting(params, "verify_checksum", False):
+        digest = TransferDigest()
+
+    # compressed uploads are a single stream - the compressed size isn't known up front
+    transferred = None
+    expected_size = os.path.getsize(path_to_file)
+    if compression is not None:
+        irods_file = open_object("w")
+        try:
+            writer = CompressingWriter(irods_file, compression, get_setting(params, "compression_level", 0) or None,
+                                       digest)
+            send_file(path_to_file, writer, buffer_size)
+            writer.finish()
+            irods_file.flush()
+        finally:
+            irods_file.close()
+        if writer.raw_bytes != expected_size:
+            raise Exception("Upload of " + name_of_file + " is incomplete: " + str(writer.raw_bytes) + " of " +
+                            str(expected_size) + " bytes compressed")
+        transferred = expected_size = writer.compressed_bytes
+        print("Compressed " + name_of_file + ": " + format_compression(writer.raw_bytes, writer.compressed_bytes))
+
+    # large files are split into byte ranges which are uploaded in parallel - if iRODS doesn't allow parallel
+    # writes into the object, the file is uploaded with a single stream instead
+    streams = get_setting(params, "parallel_streams", DEFAULT_PARALLEL_STREAMS)
+    # resumable uploads only record the offset of a single stream
+    if transferred is None and digest is None and journal is None and streams > 1 and \
+            os.path.getsize(path_to_file) >= get_setting(params, "parallel_threshold", DEFAULT_PARALLEL_THRESHOLD):
+        transferred = upload_ranges(open_object, path_to_file, streams, max(1, buffer_size // streams), retry_policy)
+
+    # stream the Galaxy file into iRODS - the iRODS handle is closed (and the data committed) afterwards
+    if transferred is None:
+        transferred = upload_data_object(open_object, path_to_file, buffer_size, digest, journal, retry_policy)
+
+    # verify that iRODS holds all bytes before reporting success
+    iRODS_file_object = retry_policy.hedged(session.data_objects.get, coll_path + "/" + irods_file_name)
+    if iRODS_file_object.size != expected_size or transferred != iRODS_file_object.size:
+        raise Exception("Upload of " + name_of_file + " is incomplete: " + str(iRODS_file_object.size) + " of " +
+                        str(expected_size) + " bytes committed in iRODS")
+
+    # marks the object as compressed by the tools, with the size of the original data
+    if compression is not None:
+        iRODS_file_object.metadata.add(COMPRESSION_ATTRIBUTE, compression)
+        iRODS_file_object.metadata.add(ORIGINAL_SIZE_ATTRIBUTE, str(os.path.getsize(path_to_file)))
+
+    # compare the checksum iRODS registers for the stored data with the checksum of the sent data
+    if digest is not None:
+        verify_iRODS_checksum(session, iRODS_file_object, digest)
+
+    if journal is not None:
+        journal.remove()
+
+    return irods_file_name
+# -------------------------------------------------------------------------------------------------------------------- #
 
-    print("Successfully uploaded: " + name_of_file + "\n as: " + irods_file_name)
-    # TODO can't close session without writing process finished - but reading/writing happens async.
-    # session.cleanup()
 
-    pass
+########################################################################################################################
+#   Function to register the checksum of an uploaded data object in iRODS and compare it with the checksum computed
+#   while sending the data. If the iRODS client can't register checksums, the computed checksum is attached to the
+#   object as metadata instead.
+#
+#   IN:
+#   iRODSSession-object session
+#   iRODSDataObject data_object
+#   TransferDigest digest
+#
+#   OUT:
+#
+########################################################################################################################
+def verify_iRODS_checksum(session, data_object, digest):
+
+    irods_checksum = None
+    if hasattr(session.data_objects, "chksum"):
+        irods_checksum = retry_policy.call(session.data_objects.chksum, data_object.path)
+    elif hasattr(data_object, "chksum"):
+        irods_checksum = retry_policy.call(data_object.chksum)
+
+    if not irods_checksum:
+        data_object.metadata.add("galaxy_irods::checksum", digest.get_irods_checksum())
+        return
+
+    if not digest.matches(irods_checksum):
+        raise Exception("Checksum mismatch for " + data_object.path + ": iRODS has " + irods_checksum +
+                        ", the uploaded data has " + digest.get_irods_checksum(irods_checksum))
 # -------------------------------------------------------------------------------------------------------------------- #
 
 
 ########################################################################################################################
-#   Function to initialize an iRODS Session - will raise an Exception if timeout is longer than 2 seconds
+#   Function to initialize an iRODS Session. python-irodsclient only connects with the first request, so the server
+#   is checked for reachability within the connect timeout up front. All requests of the session use the read timeout.
 #
 #   IN:
 #   String host
@@ -550,35 +1608,56 @@ def handle_upload_call(params):
 #   iRODSSession-object session
 ########################################################################################################################
 def get_iRODS_connection(host, port, user, password, zone):
+    from irods.session import iRODSSession
 
-    # initialize timeout checker - fires after 2 secs
-    import signal
-    signal.signal(signal.SIGALRM, timeout_checker)
-    signal.alarm(2)
+    global iRODSTimeouts, retry_policy
 
-    try:
-        session = iRODSSession(host=host, port=port, user=user, password=password, zone=zone)
-    except Exception:
-        raise Exception("There was a timeout creating the iRODS session")
+    def probe():
+        socket.create_connection((host, int(port)), iRODSTimeouts["connect"]).close()
 
-    # void/reset alarm
-    signal.alarm(0)
+    with metrics.phase("auth"):
+        try:
+            retry_policy.call(probe)
+        except Exception as e:
+            raise Exception("Could not connect to the iRODS server " + host + ":" + str(port) + " (" + str(e) + ")")
+
+        session = iRODSSession(host=host, port=port, user=user, password=password, zone=zone)
+        session.connection_timeout = iRODSTimeouts["read"]
 
     return session
 # -------------------------------------------------------------------------------------------------------------------- #
 
 
 ########################################################################################################################
-#   Helper function to raise timeout exception when SIGALRM fires
+#   Returns the iRODS credentials of the tool parameters in the form the connection broker expects
 #
 #   IN:
+#   Dict params
 #
 #   OUT:
+#   Dict credentials
+########################################################################################################################
+def get_broker_credentials(params):
+
+    return {"host": params["irods_host"], "port": params["irods_port"], "zone": params["irods_zone"],
+            "user": params["irods_user"], "password": params["irods_password"]}
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Function to initialize an additional iRODS Session for the session pool with the global credentials
+#
+#   IN:
 #
+#   OUT:
+#   iRODSSession-object session
 ########################################################################################################################
-def timeout_checker():
+def get_pooled_iRODS_connection():
 
-    raise Exception("iRODS session timeout")
+    global iRODSCredentials
+    return get_iRODS_connection(host=iRODSCredentials["host"], port=iRODSCredentials["port"],
+                                user=iRODSCredentials["user"], password=iRODSCredentials["pw"],
+                                zone=iRODSCredentials["zone"])
 # -------------------------------------------------------------------------------------------------------------------- #
 
 
@@ -604,7 +1683,114 @@ def check_if_file_exists(path):
 
 
 ########################################################################################################################
-#   Function to check iRODS destination
+#   Function to list all data objects below an iRODS collection with GenQuery. Instead of walking every
+#   (sub)collection, all objects are fetched with one paged query for the collection itself and one for all
+#   subcollections.
+#
+#   IN:
+#   iRODSSession-object session
+#   String coll_path
+#   Bool recursive
+#
+#   OUT:
+#   List file_list (dicts with "path", "name", "size", "checksum" and "modify_time" of each data object)
+#
+########################################################################################################################
+def list_iRODS_collection(session, coll_path, recursive=True):
+    from irods.models import Collection, DataObject
+    from irods.column import Like
+
+    coll_path = coll_path.rstrip("/")
+    columns = (Collection.name, DataObject.name, DataObject.size, DataObject.checksum, DataObject.modify_time)
+
+    queries = [session.query(*columns).filter(Collection.name == coll_path)]
+    if recursive:
+        queries.append(session.query(*columns).filter(Like(Collection.name, coll_path + "/%")))
+
+    files = {}
+    for query in queries:
+        for result_set in query.get_batches():
+            for row in result_set:
+                # LIKE treats "_" and "%" in the path as wildcards
+                if row[Collection.name] != coll_path and not row[Collection.name].startswith(coll_path + "/"):
+                    continue
+                path = row[Collection.name] + "/" + row[DataObject.name]
+                # every replica of an object is a separate row
+                if path not in files:
+                    files[path] = {"path": path,
+                                   "name": row[DataObject.name],
+                                   "size": int(row[DataObject.size] or 0),
+                                   "checksum": row[DataObject.checksum],
+                                   "modify_time": row[DataObject.modify_time]}
+
+    return [files[path] for path in sorted(files)]
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Returns the mounts of iRODS resource vaults on the Galaxy node from the vault_mounts setting - a comma separated
+#   list of <vault path>=<local path>. Without the setting, the vaults are expected under their own path.
+#
+#   IN:
+#   Dict params
+#
+#   OUT:
+#   List vault_mounts (list of [vault path, local path], longest vault path first)
+#
+########################################################################################################################
+def get_vault_mounts(params):
+
+    vault_mounts = []
+    for mount in get_setting(params, "vault_mounts", "").split(","):
+        if mount.strip() == "":
+            continue
+        vault_path, _, local_path = mount.partition("=")
+        vault_path = vault_path.strip().rstrip("/")
+        local_path = (local_path.strip() or vault_path).rstrip("/")
+        vault_mounts.append([vault_path, local_path])
+
+    if not vault_mounts:
+        vault_mounts.append(["", ""])
+
+    return sorted(vault_mounts, key=lambda mount: len(mount[0]), reverse=True)
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Returns the local path of a good replica of a data object in a mounted resource vault, or None if no replica is
+#   readable on the Galaxy node with the size of the object
+#
+#   IN:
+#   iRODSSession-object session
+#   Dict file_entry
+#   List vault_mounts
+#
+#   OUT:
+#   String vault_path (or None)
+#
+########################################################################################################################
+def get_vault_path(session, file_entry, vault_mounts):
+
+    data_object = retry_policy.hedged(session.data_objects.get, file_entry["path"])
+    for replica in data_object.replicas:
+        # stale replicas may differ from the object
+        if str(replica.status) != "1":
+            continue
+        for vault_path, local_path in vault_mounts:
+            if not replica.path.startswith(vault_path + "/"):
+                continue
+            vault_file = local_path + replica.path[len(vault_path):]
+            if os.path.isfile(vault_file) and os.path.getsize(vault_file) == data_object.size:
+                return vault_file
+            break
+
+    return None
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Function to check iRODS destination - fetches the data object with a single catalog request, the collection
+#   is only looked up if the data object doesn't exist
 #
 #   IN:
 #   iRODSSession-object session
@@ -612,20 +1798,23 @@ def check_if_file_exists(path):
 #   String name
 #
 #   OUT:
-#   Bool ret_bool
+#   iRODSDataObject data_object
 #
 ########################################################################################################################
 def check_iRODS_destination(session, path, name):
 
-    try:
-        session.collections.get(path.rstrip("/"))
-    except Exception:
-        raise Exception("Collection doesn't exist in iRODS file system")
+    with metrics.phase("catalog"):
+        try:
+            return retry_policy.hedged(session.data_objects.get, path.rstrip("/") + "/" + name)
+        except Exception:
+            pass
 
-    try:
-        session.data_objects.get(path.rstrip("/") + "/" + name)
-    except Exception:
-        raise Exception("File doesn't exist in iRODS file system")
+        try:
+            retry_policy.hedged(session.collections.get, path.rstrip("/"))
+        except Exception:
+            raise Exception("Collection doesn't exist in iRODS file system")
+
+    raise Exception("File doesn't exist in iRODS file system")
 # -------------------------------------------------------------------------------------------------------------------- #
 
 
@@ -0,0 +1,271 @@
+# Timing and throughput metrics of the iRODS tools.
+#
+# Every run records the time spent in its phases (startup, auth, catalog, transfer, bundle, ingest), the bytes
+# transferred and the retries and hedged requests of its RetryPolicy. Phases of parallel transfers are recorded with
+# their busy time (summed over all threads) and their wall time (first start to last end) - the throughput is computed
+# from the wall time. The metrics are written as a JSON file next to the job, and optionally added to the counters of
+# a Prometheus textfile collector file shared by all jobs of the node.
+
+import os
+import re
+import json
+import time
+import threading
+
+from contextlib import contextmanager
+
+# default JSON file of a run, relative to the job working directory
+DEFAULT_METRICS_FILE = "irods_metrics.json"
+
+# Prometheus metrics written to the textfile - name: (type, help)
+PROMETHEUS_METRICS = {
+    "galaxy_irods_jobs_total": ("counter", "iRODS tool runs by operation and status"),
+    "galaxy_irods_phase_seconds_total": ("counter", "Busy time of the phases of iRODS tool runs, summed over threads"),
+    "galaxy_irods_phase_wall_seconds_total": ("counter", "Wall time of the phases of iRODS tool runs"),
+    "galaxy_irods_transferred_bytes_total": ("counter", "Bytes transferred by iRODS tool runs"),
+    "galaxy_irods_transfers_total": ("counter", "Transfers (files or bundles) of iRODS tool runs"),
+    "galaxy_irods_retries_total": ("counter", "Retried iRODS calls and transfers"),
+    "galaxy_irods_hedged_requests_total": ("counter", "Hedged iRODS metadata requests"),
+    "galaxy_irods_last_throughput_bytes_per_second": ("gauge", "Transfer throughput of the last iRODS tool run"),
+    "galaxy_irods_last_duration_seconds": ("gauge", "Duration of the last iRODS tool run"),
+    "galaxy_irods_last_timestamp_seconds": ("gauge", "End of the last iRODS tool run"),
+}
+PROMETHEUS_LINE = re.compile(r"^(\w+)(?:\{(.*)\})? (\S+)$")
+
+
+########################################################################################################################
+#   Metrics of one tool run - thread-safe, so parallel transfers can record into the same object
+#
+#   IN:
+#   String operation ("up" or "down")
+#   String job_id (optional)
+#
+########################################################################################################################
+class TransferMetrics:
+    def __init__(self, operation="", job_id=None):
+        self.operation = operation
+        self.job_id = job_id
+        self.status = "failed"
+        self.started = time.time()
+        self.started_counter = time.perf_counter()
+        self.phases = {}
+        self.transfers = []
+        self.lock = threading.Lock()
+
+    # records time spent in a phase - started and ended are time.perf_counter() values
+    def add_phase(self, name, seconds, byte_count=0, started=None, ended=None):
+        if ended is None:
+            ended = time.perf_counter()
+        if started is None:
+            started = ended - seconds
+        with self.lock:
+            phase = self.phases.setdefault(name, {"seconds": 0.0, "count": 0, "bytes": 0, "first": started,
+                                                  "last": ended})
+            phase["seconds"] += seconds
+            phase["count"] += 1
+            phase["bytes"] += byte_count
+            phase["first"] = min(phase["first"], started)
+            phase["last"] = max(phase["last"], ended)
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            ended = time.perf_counter()
+            self.add_phase(name, ended - started, 0, started, ended)
+
+    # wraps a transfer function (called as transfer(session, item)) - every call is recorded as a transfer of the phase,
+    # count_bytes(item, result) returns the bytes it transferred
+    def measure(self, name, transfer, count_bytes):
+        def measured(session, item):
+            started = time.perf_counter()
+            byte_count = 0
+            success = False
+            try:
+                result = transfer(session, item)
+                byte_count = count_bytes(item, result)
+                success = True
+                return result
+            finally:
+                ended = time.perf_counter()
+                self.add_phase(name, ended - started, byte_count, started, ended)
+                with self.lock:
+                    self.transfers.append({"phase": name,
+                                           "path": item["path"] if isinstance(item, dict) else
+                                           "bundle of " + str(len(item)) + " files",
+                                           "bytes": byte_count,
+                                           "seconds": round(ended - started, 6),
+                                           "mb_per_s": get_mb_per_s(byte_count, ended - started),
+                                           "ok": success})
+        return measured
+
+    def to_dict(self, retry_policy=None):
+        with self.lock:
+            phases = {}
+            for name, phase in self.phases.items():
+                wall_seconds = phase["last"] - phase["first"]
+                phases[name] = {"seconds": round(phase["seconds"], 6),
+                                "wall_seconds": round(wall_seconds, 6),
+                                "count": phase["count"],
+                                "bytes": phase["bytes"],
+                                "mb_per_s": get_mb_per_s(phase["bytes"], wall_seconds)}
+
+            transferred = sum(phases[name]["bytes"] for name in ("transfer", "bundle") if name in phases)
+            transfer_wall = get_wall_seconds([self.phases[name] for name in ("transfer", "bundle")
+                                              if name in self.phases])
+            return {"operation": self.operation,
+                    "job_id": self.job_id,
+                    "status": self.status,
+                    "started": self.started,
+                    "seconds": round(time.perf_counter() - self.started_counter +
+                                     self.phases.get("startup", {}).get("seconds", 0.0), 6),
+                    "bytes": transferred,
+                    "transfer_seconds": round(transfer_wall, 6),
+                    "mb_per_s": get_mb_per_s(transferred, transfer_wall),
+                    "retries": retry_policy.retry_count if retry_policy is not None else 0,
+                    "hedged_requests": retry_policy.hedge_count if retry_policy is not None else 0,
+                    "phases": phases,
+                    "transfers": list(self.transfers)}
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Throughput in MB/s (10^6 bytes per second), 0 for empty or instant transfers
+#
+#   IN:
+#   Int byte_count
+#   Float seconds
+#
+#   OUT:
+#   Float mb_per_s
+#
+########################################################################################################################
+def get_mb_per_s(byte_count, seconds):
+
+    if byte_count <= 0 or seconds <= 0:
+        return 0.0
+
+    return round(byte_count / seconds / 1000000.0, 3)
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Wall time covered by several phases - from the first start to the last end
+#
+#   IN:
+#   List phases
+#
+#   OUT:
+#   Float wall_seconds
+#
+########################################################################################################################
+def get_wall_seconds(phases):
+
+    if not phases:
+        return 0.0
+
+    return max(phase["last"] for phase in phases) - min(phase["first"] for phase in phases)
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Formats the summary line of a run for the job output
+#
+#   IN:
+#   Dict summary (from TransferMetrics.to_dict)
+#
+#   OUT:
+#   String line
+#
+########################################################################################################################
+def format_metrics(summary):
+
+    phases = ", ".join(name + " " + "%.2f" % phase["wall_seconds"] + " s"
+                       for name, phase in sorted(summary["phases"].items()))
+    return "iRODS " + summary["operation"] + ": " + str(summary["bytes"]) + " bytes in " + \
+        "%.2f" % summary["transfer_seconds"] + " s (" + str(summary["mb_per_s"]) + " MB/s), " + \
+        str(summary["retries"]) + " retries - " + phases
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Writes the metrics of a run as JSON - written to a temporary name and renamed, so readers never see a partial file
+#
+#   IN:
+#   Dict summary
+#   String path
+#
+#   OUT:
+#
+########################################################################################################################
+def write_metrics_file(summary, path):
+
+    tmp_path = path + "." + str(os.getpid()) + ".tmp"
+    with open(tmp_path, "w") as metrics_file:
+        json.dump(summary, metrics_file, indent=2)
+    os.replace(tmp_path, path)
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Adds the metrics of a run to a Prometheus textfile collector file. The file holds counters over all runs of the
+#   node (and gauges of the last run per operation), so parallel jobs update it under a lock.
+#
+#   IN:
+#   Dict summary
+#   String path
+#
+#   OUT:
+#
+########################################################################################################################
+def update_prometheus_textfile(summary, path):
+    import fcntl
+
+    operation = 'operation="' + summary["operation"] + '"'
+    updates = [("galaxy_irods_jobs_total", operation + ',status="' + summary["status"] + '"', 1),
+               ("galaxy_irods_transferred_bytes_total", operation, summary["bytes"]),
+               ("galaxy_irods_transfers_total", operation, len(summary["transfers"])),
+               ("galaxy_irods_retries_total", operation, summary["retries"]),
+               ("galaxy_irods_hedged_requests_total", operation, summary["hedged_requests"])]
+    for name, phase in summary["phases"].items():
+        labels = operation + ',phase="' + name + '"'
+        updates.append(("galaxy_irods_phase_seconds_total", labels, phase["seconds"]))
+        updates.append(("galaxy_irods_phase_wall_seconds_total", labels, phase["wall_seconds"]))
+    gauges = [("galaxy_irods_last_throughput_bytes_per_second", operation, summary["mb_per_s"] * 1000000.0),
+              ("galaxy_irods_last_duration_seconds", operation, summary["seconds"]),
+              ("galaxy_irods_last_timestamp_seconds", operation, time.time())]
+
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        values = {}
+        try:
+            with open(path) as textfile:
+                for line in textfile:
+                    match = PROMETHEUS_LINE.match(line.strip())
+                    if match is not None and match.group(1) in PROMETHEUS_METRICS:
+                        values[(match.group(1), match.group(2) or "")] = float(match.group(3))
+        except (OSError, ValueError):
+            values = {}
+
+        for name, labels, value in updates:
+            values[(name, labels)] = values.get((name, labels), 0.0) + value
+        for name, labels, value in gauges:
+            values[(name, labels)] = value
+
+        # the collector must never read a partially written file
+        tmp_path = path + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_path, "w") as textfile:
+            for name in sorted(PROMETHEUS_METRICS):
+                samples = sorted((labels, value) for (sample_name, labels), value in values.items()
+                                 if sample_name == name)
+                if not samples:
+                    continue
+                textfile.write("# HELP " + name + " " + PROMETHEUS_METRICS[name][1] + "\n")
+                textfile.write("# TYPE " + name + " " + PROMETHEUS_METRICS[name][0] + "\n")
+                for labels, value in samples:
+                    textfile.write(name + ("{" + labels + "}" if labels else "") + " " + repr(float(value)) + "\n")
+        os.replace(tmp_path, path)
+# -------------------------------------------------------------------------------------------------------------------- #
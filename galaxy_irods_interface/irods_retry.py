@@ -0,0 +1,133 @@
+# Retries and hedged requests for the iRODS tools.
+#
+# Network errors and timeouts of catalog calls and transfer chunks are retried a bounded number of times with
+# jittered exponential backoff, so a slow or briefly unreachable iCAT delays a job instead of failing it. Errors
+# that won't go away by trying again (invalid login, missing objects, local disk errors) are raised immediately.
+
+import time
+import random
+import socket
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# default timeout for establishing a connection to the iRODS server in seconds
+DEFAULT_CONNECT_TIMEOUT = 10
+# default timeout for a single reply of the iRODS server in seconds
+DEFAULT_READ_TIMEOUT = 120
+# default number of retries of a failed catalog call or transfer
+DEFAULT_RETRIES = 4
+# base and upper bound of the backoff between two retries in seconds
+DEFAULT_RETRY_DELAY = 0.5
+DEFAULT_RETRY_MAX_DELAY = 10.0
+# metadata queries that didn't answer after this many seconds are sent a second time (0 disables hedging)
+DEFAULT_HEDGE_DELAY = 0.0
+
+# python-irodsclient errors that are caused by the network rather than by the request
+TRANSIENT_IRODS_ERRORS = {"NetworkException", "SYS_SOCK_READ_TIMEDOUT", "SYS_SOCK_READ_ERR", "SYS_HEADER_READ_LEN_ERR",
+                          "SYS_SOCK_CONNECT_ERR", "SYS_AGENT_INIT_ERR"}
+
+
+########################################################################################################################
+#   Decides if an error is worth a retry
+#
+#   IN:
+#   Exception error
+#
+#   OUT:
+#   Bool transient
+#
+########################################################################################################################
+def is_transient_error(error):
+
+    if isinstance(error, (socket.timeout, ConnectionError, EOFError)):
+        return True
+
+    return any(error_class.__name__ in TRANSIENT_IRODS_ERRORS for error_class in type(error).__mro__)
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Runs a function in a thread and starts a second, identical call if the first one didn't finish after delay
+#   seconds. The first successful result is returned, the slower call is left to finish in the background.
+#
+#   IN:
+#   Function function
+#   Float delay
+#   Function on_hedge (optional, called when the second call is started)
+#
+#   OUT:
+#   result (of the function)
+#
+########################################################################################################################
+def hedged_call(function, delay, on_hedge=None):
+
+    executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        pending = {executor.submit(function)}
+        done, pending = wait(pending, timeout=delay)
+        if not done:
+            if on_hedge is not None:
+                on_hedge()
+            pending.add(executor.submit(function))
+
+        error = None
+        while True:
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = error or future.exception()
+            if not pending:
+                raise error
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+    finally:
+        executor.shutdown(wait=False)
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Retry policy shared by all iRODS calls of a tool run. Counts the retries and hedged requests it made.
+#
+#   IN:
+#   Int retries
+#   Float delay (backoff before the first retry, doubled for every further retry)
+#   Float max_delay
+#   Float hedge_delay (0 disables hedged requests)
+#
+########################################################################################################################
+class RetryPolicy:
+    def __init__(self, retries=DEFAULT_RETRIES, delay=DEFAULT_RETRY_DELAY, max_delay=DEFAULT_RETRY_MAX_DELAY,
+                 hedge_delay=DEFAULT_HEDGE_DELAY):
+        self.retries = max(0, int(retries))
+        self.delay = max(0.0, float(delay))
+        self.max_delay = max(0.0, float(max_delay))
+        self.hedge_delay = max(0.0, float(hedge_delay))
+        self.retry_count = 0
+        self.hedge_count = 0
+        self.lock = threading.Lock()
+
+    def call(self, function, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.retries or not is_transient_error(e):
+                    raise
+            # full jitter - parallel transfers that failed together don't retry in lockstep
+            time.sleep(random.uniform(0, min(self.max_delay, self.delay * 2 ** attempt)))
+            attempt += 1
+            with self.lock:
+                self.retry_count += 1
+
+    # for idempotent metadata requests only - the request may reach the server twice
+    def hedged(self, function, *args, **kwargs):
+        if self.hedge_delay <= 0:
+            return self.call(function, *args, **kwargs)
+
+        def count_hedge():
+            with self.lock:
+                self.hedge_count += 1
+
+        return self.call(hedged_call, lambda: function(*args, **kwargs), self.hedge_delay, count_hedge)
+# -------------------------------------------------------------------------------------------------------------------- #
@@ -0,0 +1,791 @@
+# Chunked transfer engine used by the iRODS download and upload tools.
+#
+# All transfers move data in fixed-size chunks through a single preallocated buffer, so the memory used by a
+# transfer only depends on the configured buffer size and never on the size of the transferred object.
+
+import os
+import json
+import mmap
+import queue
+import base64
+import hashlib
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+
+# default size of one transfer chunk in bytes
+DEFAULT_BUFFER_SIZE = 4 * 1024 * 1024
+# default upper bound for all transfer buffers of one tool run combined in bytes
+DEFAULT_MEMORY_LIMIT = 64 * 1024 * 1024
+# default number of files transferred in parallel
+DEFAULT_WORKERS = 4
+# objects of at least this size (bytes) are split into byte ranges that are transferred in parallel
+DEFAULT_PARALLEL_THRESHOLD = 256 * 1024 * 1024
+# default number of parallel byte-range streams for one object
+DEFAULT_PARALLEL_STREAMS = 4
+# resumable transfers record their progress after every this many bytes (per stream)
+DEFAULT_CHECKPOINT_INTERVAL = 64 * 1024 * 1024
+# bytes at the start of a downloaded object that are kept in memory for sniffing - Galaxy's sniff prefix
+DEFAULT_PREFIX_SIZE = 1024 * 1024
+
+
+########################################################################################################################
+#   Computes the chunk size of a single transfer stream, so that all concurrent streams together stay below
+#   the memory limit
+#
+#   IN:
+#   Int buffer_size
+#   Int memory_limit
+#   Int streams
+#
+#   OUT:
+#   Int chunk_size
+#
+########################################################################################################################
+def get_buffer_size(buffer_size=DEFAULT_BUFFER_SIZE, memory_limit=DEFAULT_MEMORY_LIMIT, streams=1):
+
+    buffer_size = int(buffer_size)
+    memory_limit = int(memory_limit)
+    streams = max(1, int(streams))
+
+    if buffer_size <= 0 or memory_limit <= 0:
+        raise Exception("Transfer buffer size and memory limit have to be positive!")
+
+    chunk_size = min(buffer_size, memory_limit // streams)
+    if chunk_size <= 0:
+        raise Exception("Memory limit is too small for " + str(streams) + " transfer streams!")
+
+    return chunk_size
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Checksum of a transfer that is computed incrementally from the transferred chunks. Supports the iRODS checksum
+#   formats "sha2:<base64 sha256>" and "<hex md5>". If the expected iRODS checksum is known, only the matching
+#   algorithm is computed.
+#
+#   IN:
+#   String irods_checksum (optional, expected checksum)
+#
+########################################################################################################################
+class TransferDigest:
+    def __init__(self, irods_checksum=None):
+        self.sha256 = None
+        self.md5 = None
+        if irods_checksum is None or irods_checksum.startswith("sha2:"):
+            self.sha256 = hashlib.sha256()
+        if irods_checksum is None or not irods_checksum.startswith("sha2:"):
+            self.md5 = hashlib.md5()
+
+    def update(self, chunk):
+        if self.sha256 is not None:
+            self.sha256.update(chunk)
+        if self.md5 is not None:
+            self.md5.update(chunk)
+
+    # returns the checksum in the given iRODS format
+    def get_irods_checksum(self, irods_format="sha2:"):
+        if irods_format.startswith("sha2:") and self.sha256 is not None:
+            return "sha2:" + base64.b64encode(self.sha256.digest()).decode("ascii")
+        if self.md5 is not None:
+            return self.md5.hexdigest()
+        return None
+
+    def matches(self, irods_checksum):
+        return self.get_irods_checksum(irods_checksum) == irods_checksum
+
+    # snapshot of the current state - a retried transfer continues from the snapshot of its last committed position
+    def copy(self):
+        snapshot = TransferDigest.__new__(TransferDigest)
+        snapshot.sha256 = self.sha256.copy() if self.sha256 is not None else None
+        snapshot.md5 = self.md5.copy() if self.md5 is not None else None
+        return snapshot
+
+    def restore(self, snapshot):
+        self.sha256 = snapshot.sha256.copy() if snapshot.sha256 is not None else None
+        self.md5 = snapshot.md5.copy() if snapshot.md5 is not None else None
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Keeps the first bytes of a download in memory while it streams, so the file doesn't have to be read again to sniff
+#   its datatype. The handles of the transfer are wrapped with record - every stream, retry and byte range records the
+#   bytes it reads below size at their offset.
+#
+#   IN:
+#   Int size
+#
+########################################################################################################################
+class PrefixRecorder:
+    def __init__(self, size=DEFAULT_PREFIX_SIZE):
+        self.size = size
+        self.data = bytearray(size)
+        # contiguous bytes from the start of the object
+        self.length = 0
+        self.lock = threading.Lock()
+
+    def record(self, handle):
+        return RecordingReader(handle, self)
+
+    def add(self, offset, chunk):
+        if offset >= self.size:
+            return
+        end = min(self.size, offset + len(chunk))
+        with self.lock:
+            self.data[offset:end] = chunk[:end - offset]
+            if offset <= self.length < end:
+                self.length = end
+
+    # the prefix - only if it is complete (size bytes, or the whole object), otherwise None
+    def get_prefix(self, object_size):
+        if self.length < min(self.size, object_size):
+            return None
+        return bytes(self.data[:self.length])
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Readable file object that passes everything read from a handle to a PrefixRecorder
+#
+#   IN:
+#   File-object handle
+#   PrefixRecorder recorder
+#
+########################################################################################################################
+class RecordingReader:
+    def __init__(self, handle, recorder):
+        self.handle = handle
+        self.recorder = recorder
+        self.position = 0
+
+    def readinto(self, buffer):
+        read = self.handle.readinto(buffer)
+        if read:
+            if self.position < self.recorder.size:
+                self.recorder.add(self.position, memoryview(buffer)[:read])
+            self.position += read
+        return read
+
+    def seek(self, offset, whence=0):
+        position = self.handle.seek(offset, whence)
+        self.position = offset if position is None else position
+        return self.position
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Copies a readable file object into a writable file object chunk by chunk, reusing one buffer
+#
+#   IN:
+#   File-object source (has to support readinto)
+#   File-object sink
+#   Int buffer_size
+#   TransferDigest digest (optional, is updated with every chunk)
+#   Function checkpoint (optional, called as checkpoint(transferred) after every checkpoint_interval bytes)
+#   Int checkpoint_interval
+#
+#   OUT:
+#   Int transferred
+#
+########################################################################################################################
+def stream_copy(source, sink, buffer_size=DEFAULT_BUFFER_SIZE, digest=None, checkpoint=None,
+                checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL):
+
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    transferred = 0
+    since_checkpoint = 0
+
+    while True:
+        read = source.readinto(buffer)
+        if not read:
+            break
+        sink.write(view[:read])
+        if digest is not None:
+            digest.update(view[:read])
+        transferred += read
+        since_checkpoint += read
+        if checkpoint is not None and since_checkpoint >= checkpoint_interval:
+            checkpoint(transferred)
+            since_checkpoint = 0
+
+    return transferred
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Calls a transfer function once, or with the retries of a RetryPolicy
+#
+#   IN:
+#   RetryPolicy retry (optional)
+#   Function function
+#
+#   OUT:
+#   result (of the function)
+#
+########################################################################################################################
+def call_with_retry(retry, function):
+
+    if retry is None:
+        return function()
+
+    return retry.call(function)
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Updates a digest with the first bytes of a local file - used to continue the checksum of a resumed transfer
+#
+#   IN:
+#   String local_path
+#   Int length
+#   TransferDigest digest
+#   Int buffer_size
+#
+#   OUT:
+#
+########################################################################################################################
+def digest_file_prefix(local_path, length, digest, buffer_size=DEFAULT_BUFFER_SIZE):
+
+    buffer = bytearray(min(buffer_size, max(1, length)))
+    view = memoryview(buffer)
+    remaining = length
+
+    with open(local_path, "rb") as local_file:
+        while remaining > 0:
+            read = local_file.readinto(view[:min(len(buffer), remaining)])
+            if not read:
+                raise Exception("Partial file " + local_path + " is shorter than its journal")
+            digest.update(view[:read])
+            remaining -= read
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Journal of a resumable transfer. It is stored as a small JSON file next to the partial data and holds the
+#   identity of the transferred object (e.g. path, size and modify time) and the progress of the transfer. A journal
+#   whose identity doesn't match the current object is ignored, so a changed object is transferred from the start.
+#
+#   IN:
+#   String journal_path
+#   Dict identity
+#
+########################################################################################################################
+class TransferJournal:
+    def __init__(self, journal_path, identity):
+        self.journal_path = journal_path
+        self.identity = {key: str(value) for key, value in identity.items()}
+        self.progress = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.journal_path, "r") as jf:
+                journal = json.load(jf)
+        except (OSError, ValueError):
+            journal = {}
+
+        self.progress = journal.get("progress", {}) if journal.get("identity") == self.identity else {}
+        return self.progress
+
+    def save(self, key, value):
+        with self.lock:
+            self.progress[key] = value
+            with open(self.journal_path + ".tmp", "w") as jf:
+                json.dump({"identity": self.identity, "progress": self.progress}, jf)
+                jf.flush()
+                os.fsync(jf.fileno())
+            os.replace(self.journal_path + ".tmp", self.journal_path)
+
+    def remove(self):
+        self.progress = {}
+        try:
+            os.remove(self.journal_path)
+        except OSError:
+            pass
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Streams an iRODS data object into a local file. With a journal, the transfer continues after the last recorded
+#   offset of a previous attempt. With a retry policy, a broken stream is reopened after the bytes already written.
+#
+#   IN:
+#   Function open_object (called as open_object(mode), returns a new handle of the data object)
+#   String local_path
+#   Int buffer_size
+#   TransferDigest digest (optional)
+#   TransferJournal journal (optional)
+#   RetryPolicy retry (optional)
+#
+#   OUT:
+#   Int size (bytes in the local file, including resumed bytes)
+#
+########################################################################################################################
+def download_data_object(open_object, local_path, buffer_size=DEFAULT_BUFFER_SIZE, digest=None, journal=None,
+                         retry=None):
+
+    offset = 0
+    if journal is not None:
+        offset = int(journal.load().get("0", 0))
+        if not os.path.isfile(local_path) or os.path.getsize(local_path) < offset:
+            offset = 0
+
+    with open(local_path, "r+b" if offset > 0 else "wb") as output_file:
+        if offset > 0:
+            if digest is not None:
+                digest_file_prefix(local_path, offset, digest, buffer_size)
+            output_file.seek(offset)
+            output_file.truncate()
+
+        def checkpoint(transferred):
+            output_file.flush()
+            os.fsync(output_file.fileno())
+            journal.save("0", output_file.tell())
+
+        # chunks are only written (and digested) after they were read completely, so a failed attempt ends
+        # exactly at the current position of the local file
+        def copy():
+            position = output_file.tell()
+            with open_object("r") as input_file:
+                if position > 0:
+                    input_file.seek(position)
+                stream_copy(input_file, output_file, buffer_size, digest, checkpoint if journal is not None else None)
+
+        call_with_retry(retry, copy)
+
+        return output_file.tell()
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Sends a local file to an open iRODS file handle. The file is memory-mapped and sent in slices of the mapping,
+#   so no user-space copy of the content is made. Pages that were already sent are released again, which keeps the
+#   resident memory bounded by the buffer size. Files that can't be mapped are sent with a regular chunked copy.
+#
+#   IN:
+#   String local_path
+#   File-object irods_file
+#   Int buffer_size
+#   TransferDigest digest (optional, is updated with every chunk)
+#   Int offset (position in the file to start from - the iRODS handle has to be at the same position)
+#   Function checkpoint (optional, called as checkpoint(position) after every checkpoint_interval bytes)
+#
+#   OUT:
+#   Int size (position in the file after the transfer)
+#
+########################################################################################################################
+def send_file(local_path, irods_file, buffer_size=DEFAULT_BUFFER_SIZE, digest=None, offset=0, checkpoint=None):
+
+    with open(local_path, "rb") as galaxy_file:
+        size = os.fstat(galaxy_file.fileno()).st_size
+        if size <= offset:
+            return size
+
+        try:
+            mapped = mmap.mmap(galaxy_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            galaxy_file.seek(offset)
+            return offset + stream_copy(galaxy_file, irods_file, buffer_size, digest,
+                                        None if checkpoint is None else lambda copied: checkpoint(offset + copied))
+
+        if hasattr(mapped, "madvise"):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+
+        view = memoryview(mapped)
+        released = offset - offset % mmap.PAGESIZE
+        since_checkpoint = 0
+        try:
+            while offset < size:
+                end = min(offset + buffer_size, size)
+                chunk = view[offset:end]
+                try:
+                    irods_file.write(chunk)
+                    if digest is not None:
+                        digest.update(chunk)
+                finally:
+                    chunk.release()
+                since_checkpoint += end - offset
+                offset = end
+
+                # drop completely sent pages from the mapping
+                sent_pages = offset - offset % mmap.PAGESIZE
+                if hasattr(mapped, "madvise") and sent_pages > released:
+                    mapped.madvise(mmap.MADV_DONTNEED, released, sent_pages - released)
+                    released = sent_pages
+
+                if checkpoint is not None and since_checkpoint >= DEFAULT_CHECKPOINT_INTERVAL:
+                    checkpoint(offset)
+                    since_checkpoint = 0
+        finally:
+            view.release()
+            mapped.close()
+
+    return offset
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Streams a local file into an iRODS data object. The iRODS handle is flushed and closed explicitly, so the data
+#   is committed to iRODS when this function returns. With a loaded journal, the upload continues after the last
+#   recorded offset of a previous attempt. With a retry policy, a broken stream is reopened and continues after the
+#   last flushed checkpoint.
+#
+#   IN:
+#   Function open_object (called as open_object(mode), returns a new handle of the data object)
+#   String local_path
+#   Int buffer_size
+#   TransferDigest digest (optional)
+#   TransferJournal journal (optional, already loaded)
+#   RetryPolicy retry (optional)
+#
+#   OUT:
+#   Int size (bytes in the data object, including resumed bytes)
+#
+########################################################################################################################
+def upload_data_object(open_object, local_path, buffer_size=DEFAULT_BUFFER_SIZE, digest=None, journal=None,
+                       retry=None):
+
+    offset = 0
+    if journal is not None:
+        offset = int(journal.progress.get("offset", 0))
+        if offset > os.path.getsize(local_path):
+            offset = 0
+
+    if offset > 0 and digest is not None:
+        digest_file_prefix(local_path, offset, digest, buffer_size)
+
+    # position and digest state of the last flushed checkpoint - a retry continues from there
+    committed = {"offset": offset, "digest": digest.copy() if digest is not None else None}
+
+    def send():
+        if digest is not None:
+            digest.restore(committed["digest"])
+
+        # an interrupted upload is continued in place - "w" would truncate the object
+        irods_file = open_object("r+" if committed["offset"] > 0 else "w")
+        try:
+            if committed["offset"] > 0:
+                irods_file.seek(committed["offset"])
+
+            def checkpoint(position):
+                irods_file.flush()
+                committed["offset"] = position
+                if digest is not None:
+                    committed["digest"] = digest.copy()
+                if journal is not None:
+                    journal.save("offset", position)
+
+            transferred = send_file(local_path, irods_file, buffer_size, digest, committed["offset"],
+                                    checkpoint if journal is not None or retry is not None else None)
+            irods_file.flush()
+        finally:
+            irods_file.close()
+
+        return transferred
+
+    return call_with_retry(retry, send)
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Pool of iRODS sessions - every parallel transfer borrows its own session, so transfers never share a connection.
+#   All sessions are created up front by the calling thread.
+#
+#   IN:
+#   Function connect (returns a new iRODSSession)
+#   Int size
+#   iRODSSession session (optional, already opened session that is added to the pool)
+#
+########################################################################################################################
+class SessionPool:
+    def __init__(self, connect, size, session=None):
+        self.sessions = []
+        self.idle = queue.LifoQueue()
+
+        if session is not None:
+            self.sessions.append(session)
+        while len(self.sessions) < max(1, size):
+            self.sessions.append(connect())
+
+        for pooled_session in self.sessions:
+            self.idle.put(pooled_session)
+
+    @contextmanager
+    def session(self):
+        pooled_session = self.idle.get()
+        try:
+            yield pooled_session
+        finally:
+            self.idle.put(pooled_session)
+
+    def cleanup(self):
+        for pooled_session in self.sessions:
+            try:
+                pooled_session.cleanup()
+            except Exception:
+                pass
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Runs a transfer function for every item with a pool of worker threads. Every call gets its own pooled session.
+#   A failing item doesn't stop the other transfers - its error is collected instead.
+#
+#   IN:
+#   SessionPool pool
+#   List items
+#   Function transfer (called as transfer(session, item))
+#   Int workers
+#
+#   OUT:
+#   List results (list of (item, result) in the order of items)
+#   List failures (list of (item, error message) in the order of items)
+#
+########################################################################################################################
+def transfer_concurrently(pool, items, transfer, workers=DEFAULT_WORKERS):
+
+    def run(item):
+        with pool.session() as pooled_session:
+            return transfer(pooled_session, item)
+
+    outcomes = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(run, item): index for index, item in enumerate(items)}
+        for future in as_completed(futures):
+            try:
+                outcomes[futures[future]] = (True, future.result())
+            except Exception as e:
+                outcomes[futures[future]] = (False, str(e) or e.__class__.__name__)
+
+    results = []
+    failures = []
+    for index, item in enumerate(items):
+        success, outcome = outcomes[index]
+        if success:
+            results.append((item, outcome))
+        else:
+            failures.append((item, outcome))
+
+    return results, failures
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Splits an object of the given size into (start, end) byte ranges - one per stream
+#
+#   IN:
+#   Int size
+#   Int streams
+#
+#   OUT:
+#   List ranges
+#
+########################################################################################################################
+def split_ranges(size, streams):
+
+    streams = max(1, min(int(streams), size))
+    range_size = -(-size // streams)
+
+    return [(start, min(start + range_size, size)) for start in range(0, size, range_size)]
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Runs one function per byte range in parallel threads and re-raises the first error after all threads finished
+#
+#   IN:
+#   List ranges
+#   Function transfer (called as transfer(start, end))
+#
+#   OUT:
+#   Int transferred
+#
+########################################################################################################################
+def run_ranges(ranges, transfer):
+
+    transferred = 0
+    error = None
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        futures = [executor.submit(transfer, start, end) for start, end in ranges]
+        for future in futures:
+            try:
+                transferred += future.result()
+            except Exception as e:
+                error = error or e
+
+    if error is not None:
+        raise error
+
+    return transferred
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Downloads an iRODS data object with several parallel streams. Every stream opens its own handle (and with it its
+#   own connection) and writes its byte range directly into a preallocated local file. With a journal, every range
+#   continues after its last recorded offset of a previous attempt. With a retry policy, a broken stream is reopened
+#   after the bytes of its range already written.
+#
+#   IN:
+#   Function open_object (called as open_object(mode), returns a new handle of the data object)
+#   String local_path
+#   Int size
+#   Int streams
+#   Int buffer_size (per stream)
+#   TransferJournal journal (optional)
+#   RetryPolicy retry (optional)
+#
+#   OUT:
+#   Int transferred
+#
+########################################################################################################################
+def download_ranges(open_object, local_path, size, streams=DEFAULT_PARALLEL_STREAMS, buffer_size=DEFAULT_BUFFER_SIZE,
+                    journal=None, retry=None):
+
+    ranges = split_ranges(size, streams)
+
+    # the progress of a previous attempt is only usable for the same ranges and the complete preallocated file
+    progress = journal.load() if journal is not None else {}
+    if set(progress) - set(str(start) for start, _ in ranges) or \
+            not (os.path.isfile(local_path) and os.path.getsize(local_path) == size):
+        progress = {}
+
+    def download_range(start, end):
+        first = int(progress.get(str(start), start))
+        if first >= end:
+            return 0
+        position = {"offset": first, "since_checkpoint": 0}
+        buffer = bytearray(min(buffer_size, end - first))
+        view = memoryview(buffer)
+
+        # a retried attempt reopens the object and continues after the bytes of the range already written
+        def copy_range():
+            with open_object("r") as input_file:
+                input_file.seek(position["offset"])
+                while position["offset"] < end:
+                    offset = position["offset"]
+                    read = input_file.readinto(view[:min(len(buffer), end - offset)])
+                    if not read:
+                        raise Exception("Unexpected end of data at byte " + str(offset) + " of " + str(size))
+                    written = 0
+                    while written < read:
+                        written += os.pwrite(fd, view[written:read], offset + written)
+                    position["offset"] = offset + read
+                    position["since_checkpoint"] += read
+                    if journal is not None and position["since_checkpoint"] >= DEFAULT_CHECKPOINT_INTERVAL:
+                        os.fsync(fd)
+                        journal.save(str(start), position["offset"])
+                        position["since_checkpoint"] = 0
+
+        call_with_retry(retry, copy_range)
+        return position["offset"] - first
+
+    fd = os.open(local_path, os.O_WRONLY | os.O_CREAT | (0 if progress else os.O_TRUNC), 0o644)
+    try:
+        # reserve the whole file up front, so parallel writes never have to extend it
+        if not progress:
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except (AttributeError, OSError):
+                os.ftruncate(fd, size)
+
+        transferred = run_ranges(ranges, download_range)
+    finally:
+        os.close(fd)
+
+    return transferred
+# -------------------------------------------------------------------------------------------------------------------- #
+
+
+########################################################################################################################
+#   Uploads a local file into an existing iRODS data object with several parallel streams. Every stream opens its own
+#   handle and sends its byte range from a shared memory mapping of the file. All handles are opened before any data
+#   is sent - if iRODS refuses concurrent opens of the object, nothing is sent and None is returned, so the caller
+#   can fall back to a single stream. With a retry policy, a range whose stream broke is sent again over a new handle.
+#
+#   IN:
+#   Function open_object (called as open_object(mode), returns a new handle of the data object)
+#   String local_path
+#   Int streams
+#   Int buffer_size (per stream)
+#   RetryPolicy retry (optional)
+#
+#   OUT:
+#   Int transferred (or None)
+#
+########################################################################################################################
+def upload_ranges(open_object, local_path, streams=DEFAULT_PARALLEL_STREAMS, buffer_size=DEFAULT_BUFFER_SIZE,
+                  retry=None):
+
+    size = os.path.getsize(local_path)
+    if size == 0:
+        return None
+    ranges = split_ranges(size, streams)
+
+    handles = []
+    try:
+        for _ in ranges:
+            handles.append(open_object("r+"))
+    except Exception:
+        for handle in handles:
+            handle.close()
+        return None
+
+    handle_of_range = dict(zip(ranges, handles))
+
+    def upload_range(start, end):
+
+        def send_range():
+            irods_file = handle_of_range[(start, end)]
+            if irods_file is None:
+                irods_file = handle_of_range[(start, end)] = open_object("r+")
+            try:
+                offset = start
+                irods_file.seek(start)
+                while offset < end:
+                    chunk = view[offset:min(offset + buffer_size, end)]
+                    try:
+                        irods_file.write(chunk)
+                        offset += len(chunk)
+                    finally:
+                        chunk.release()
+                irods_file.flush()
+            except Exception:
+                # the handle of a broken stream is not reused
+                handle_of_range[(start, end)] = None
+                try:
+                    irods_file.close()
+                except Exception:
+                    pass
+                raise
+            return offset - start
+
+        return call_with_retry(retry, send_range)
+
+    try:
+        with open(local_path, "rb") as galaxy_file:
+            with mmap.mmap(galaxy_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    transferred = run_ranges(ranges, upload_range)
+                finally:
+                    view.release()
+    finally:
+        # closing the handles commits the data in iRODS
+        for handle in handle_of_range.values():
+            if handle is not None:
+                handle.close()
+
+    return transferred
+# -------------------------------------------------------------------------------------------------------------------- #
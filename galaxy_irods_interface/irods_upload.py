@@ -5,16 +5,24 @@
 # to be reflected in galaxy.web.controllers.tool_runner and galaxy.tools
 from __future__ import print_function
 
+import base64
 import errno
+import hashlib
 import os
+import pickle
 import shutil
 import sys
-from json import dump, load, loads
-with open("python__path.txt", "r") as pp:
-    ppstr = pp.read()
-    temp = ppstr.split(",")[:-1]
-    for it in temp:
-        sys.path.append(it)
+import time
+import xml.etree.ElementTree as ElementTree
+from json import dump, dumps, load, loads
+# the iRODS tools pass their module path - only present when started by irods_main.py
+if os.path.exists("python__path.txt"):
+    with open("python__path.txt", "r") as pp:
+        ppstr = pp.read()
+        temp = ppstr.split(",")[:-1]
+        for it in temp:
+            if it not in sys.path:
+                sys.path.append(it)
 
 from galaxy.datatypes import sniff
 from galaxy.datatypes.registry import Registry
@@ -24,6 +32,7 @@ from galaxy.util import (
     safe_makedirs,
     unicodify
 )
+from galaxy.util.checkers import check_binary
 from galaxy.util.compression_utils import CompressedFile
 
 assert sys.version_info[:2] >= (2, 7)
@@ -31,6 +40,14 @@ assert sys.version_info[:2] >= (2, 7)
 
 _file_sources = None
 
+# datatypes that are always kept in a reduced registry
+BASE_DATATYPES = ('data', 'txt', 'binary', 'tabular')
+REGISTRY_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'galaxy_irods_interface')
+# magic numbers of the compressed formats Galaxy looks into while sniffing
+COMPRESSED_MAGIC = (b'\x1f\x8b', b'BZh', b'PK\x03\x04')
+# datasets sniffed from the prefix passed by the download, and the bytes that weren't read again for it
+SNIFF_STATS = dict(datasets=0, bytes=0)
+
 
 def get_file_sources():
     global _file_sources
@@ -81,6 +98,45 @@ def parse_outputs(args):
     return rval
 
 
+class StreamedFilePrefix(sniff.FilePrefix):
+    """FilePrefix of a file whose first bytes were kept in memory while it was downloaded."""
+
+    def __init__(self, filename, prefix_bytes):
+        self.filename = filename
+        self.compressed_format = None
+        self.contents_header_bytes = prefix_bytes[:sniff.SNIFF_PREFIX_BYTES]
+        self.contents_header = None
+        self.truncated = len(self.contents_header_bytes) == sniff.SNIFF_PREFIX_BYTES
+        self.non_utf8_error = None
+        try:
+            self.contents_header = self.contents_header_bytes.decode('utf-8')
+        except UnicodeDecodeError as e:
+            self.non_utf8_error = e
+        self.binary = self.non_utf8_error is not None
+
+
+def sniff_streamed_prefix(dataset, registry):
+    """Sniff the datatype of a downloaded file from the prefix passed by the download.
+
+    Sniffers that support prefixes run on the prefix in memory, only the others read the file. Returns
+    None if the prefix can't be used (incomplete or compressed) - the file is then sniffed as usual.
+    """
+    try:
+        prefix = base64.b64decode(dataset.sniff_prefix)
+        if len(prefix) < sniff.SNIFF_PREFIX_BYTES and len(prefix) != os.path.getsize(dataset.path):
+            return None
+        if prefix.startswith(COMPRESSED_MAGIC):
+            return None
+        file_prefix = StreamedFilePrefix(dataset.path, prefix)
+        ext = sniff.guess_ext(file_prefix, registry.sniff_order, is_binary=check_binary(prefix[:1024], file_path=False))
+    except Exception:
+        # a Galaxy version without FilePrefix support in guess_ext
+        return None
+    SNIFF_STATS['datasets'] += 1
+    SNIFF_STATS['bytes'] += len(file_prefix.contents_header_bytes)
+    return ext
+
+
 def add_file(dataset, registry, output_path):
     ext = None
     compression_type = None
@@ -123,6 +179,11 @@ def add_file(dataset, registry, output_path):
     except AttributeError:
         raise UploadProblemException('Unable to process uploaded file, missing file_type parameter.')
 
+    # the iRODS download passes the start of the file - sniffing doesn't have to read it again
+    requested_ext = dataset.file_type
+    if requested_ext == 'auto' and dataset.get('sniff_prefix') and os.path.exists(dataset.path):
+        requested_ext = sniff_streamed_prefix(dataset, registry) or requested_ext
+
     if dataset.type == 'url':
         try:
             dataset.path = sniff.stream_url_to_file(dataset.path, file_sources=get_file_sources())
@@ -136,7 +197,7 @@ def add_file(dataset, registry, output_path):
     stdout, ext, datatype, is_binary, converted_path = handle_upload(
         registry=registry,
         path=dataset.path,
-        requested_ext=dataset.file_type,
+        requested_ext=requested_ext,
         name=dataset.name,
         tmp_prefix='data_id_%s_upload_' % dataset.dataset_id,
         tmp_dir=output_adjacent_tmpdir(output_path),
@@ -159,6 +220,10 @@ def add_file(dataset, registry, output_path):
             err_msg = 'The uploaded files need grooming, so change your <b>Copy data into Galaxy?</b> selection to be ' + \
                 '<b>Copy files into Galaxy</b> instead of <b>Link to files without copying into Galaxy</b> so grooming can be performed.'
             raise UploadProblemException(err_msg)
+        # The iRODS tools link the output to the file in the mounted resource vault.
+        if os.path.lexists(output_path):
+            os.remove(output_path)
+        os.symlink(os.path.abspath(dataset.path), output_path)
     if not link_data_only:
         # Move the dataset to its "real" path. converted_path is a tempfile so we move it even if purge_source is False.
         if purge_source or converted_path:
@@ -289,6 +354,12 @@ def __read_old_paramfile(path):
     return datasets
 
 
+def __report_sniff_stats():
+    if SNIFF_STATS['datasets']:
+        print('Sniffed %d datasets from the streamed prefix - %d bytes not read again'
+              % (SNIFF_STATS['datasets'], SNIFF_STATS['bytes']))
+
+
 def __write_job_metadata(metadata):
     # TODO: make upload/set_metadata compatible with https://github.com/galaxyproject/galaxy/pull/4437
     with open('galaxy.json', 'w') as fh:
@@ -305,39 +376,141 @@ def output_adjacent_tmpdir(output_path):
     return os.path.dirname(output_path)
 
 
+def reduce_datatypes_config(config, extensions, path):
+    """Write a copy of the datatypes config that only registers the given extensions and no sniffers."""
+    tree = ElementTree.parse(config)
+    keep = set(extensions) | set(BASE_DATATYPES)
+    for registration in tree.getroot().iter('registration'):
+        for datatype in list(registration.findall('datatype')):
+            if datatype.get('extension') not in keep:
+                registration.remove(datatype)
+    for sniffers in tree.getroot().findall('sniffers'):
+        tree.getroot().remove(sniffers)
+    tree.write(path)
+    return path
+
+
+def load_registry(root_dir, config, extensions=None):
+    """Load the datatypes registry from a pickled cache keyed by a content hash of the config.
+
+    If the requested extensions are known (no datatype has to be sniffed), only these datatypes are
+    registered, so only their classes are imported.
+    """
+    with open(config, 'rb') as fh:
+        config_content = fh.read()
+    key = hashlib.sha256(config_content + os.path.abspath(root_dir).encode('utf-8'))
+    if extensions:
+        key.update(','.join(sorted(extensions)).encode('utf-8'))
+    cache_path = os.path.join(REGISTRY_CACHE_DIR, 'registry_%s.pickle' % key.hexdigest())
+
+    try:
+        with open(cache_path, 'rb') as fh:
+            registry = pickle.load(fh)
+        if isinstance(registry, Registry):
+            return registry
+    except Exception:
+        # missing, outdated or unreadable cache - rebuild it
+        pass
+
+    registry = Registry()
+    try:
+        safe_makedirs(REGISTRY_CACHE_DIR)
+        if extensions:
+            config = reduce_datatypes_config(config, extensions, cache_path[:-len('.pickle')] + '.xml')
+    except Exception:
+        pass
+    registry.load_datatypes(root_dir=root_dir, config=config)
+
+    try:
+        tmp_path = '%s.%d' % (cache_path, os.getpid())
+        with open(tmp_path, 'wb') as fh:
+            pickle.dump(registry, fh, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except Exception:
+        # registries that can't be pickled are simply not cached
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+    return registry
+
+
+def requested_extensions(datasets):
+    """Return the set of requested extensions, or None if any dataset has to be sniffed."""
+    extensions = set()
+    for dataset in datasets:
+        file_type = dataset.get('file_type', 'auto')
+        if dataset.get('type') == 'composite' or not file_type or file_type == 'auto':
+            return None
+        extensions.add(file_type)
+    return extensions
+
+
+def __process_dataset(dataset, registry, output_paths):
+    dataset = bunch.Bunch(**safe_dict(dataset))
+    try:
+        output_path = output_paths[int(dataset.dataset_id)][0]
+    except Exception:
+        print('Output path for dataset %s not found on command line' % dataset.dataset_id, file=sys.stderr)
+        sys.exit(1)
+    try:
+        if dataset.type == 'composite':
+            files_path = output_paths[int(dataset.dataset_id)][1]
+            return add_composite_file(dataset, registry, output_path, files_path)
+        else:
+            return add_file(dataset, registry, output_path)
+    except UploadProblemException as e:
+        return file_err(unicodify(e), dataset)
+
+
+def __stream_datasets(registry, output_paths):
+    """Process datasets from JSON lines on stdin while they arrive.
+
+    Every processed dataset is confirmed with a JSON line (its order and the seconds it took) on the file
+    descriptor in IRODS_UPLOAD_ACK_FD. The metadata is written in the order given by the "ingest_order" of
+    the datasets.
+    """
+    ack = os.fdopen(int(os.environ['IRODS_UPLOAD_ACK_FD']), 'w') if 'IRODS_UPLOAD_ACK_FD' in os.environ else None
+    metadata = []
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        dataset = loads(line)
+        order = dataset.pop('ingest_order', len(metadata))
+        started = time.time()
+        metadata.append((order, __process_dataset(dataset, registry, output_paths)))
+        if ack is not None:
+            ack.write(dumps(dict(order=order, seconds=time.time() - started)) + '\n')
+            ack.flush()
+    __write_job_metadata([meta for _, meta in sorted(metadata, key=lambda item: item[0])])
+    __report_sniff_stats()
+
+
 def __main__():
 
     if len(sys.argv) < 4:
-        print('usage: upload.py <root> <datatypes_conf> <json paramfile> <output spec> ...', file=sys.stderr)
+        print('usage: upload.py <root> <datatypes_conf> <json paramfile or -> <output spec> ...', file=sys.stderr)
         sys.exit(1)
 
     output_paths = parse_outputs(sys.argv[4:])
 
-    registry = Registry()
-    registry.load_datatypes(root_dir=sys.argv[1], config=sys.argv[2])
+    # "-" - the datasets arrive on stdin while the files are still being downloaded
+    if sys.argv[3] == '-':
+        __stream_datasets(load_registry(sys.argv[1], sys.argv[2]), output_paths)
+        return
 
     try:
         datasets = __read_paramfile(sys.argv[3])
     except (ValueError, AssertionError):
         datasets = __read_old_paramfile(sys.argv[3])
 
+    registry = load_registry(sys.argv[1], sys.argv[2], requested_extensions(datasets))
+
     metadata = []
     for dataset in datasets:
-        dataset = bunch.Bunch(**safe_dict(dataset))
-        try:
-            output_path = output_paths[int(dataset.dataset_id)][0]
-        except Exception:
-            print('Output path for dataset %s not found on command line' % dataset.dataset_id, file=sys.stderr)
-            sys.exit(1)
-        try:
-            if dataset.type == 'composite':
-                files_path = output_paths[int(dataset.dataset_id)][1]
-                metadata.append(add_composite_file(dataset, registry, output_path, files_path))
-            else:
-                metadata.append(add_file(dataset, registry, output_path))
-        except UploadProblemException as e:
-            metadata.append(file_err(unicodify(e), dataset))
+        metadata.append(__process_dataset(dataset, registry, output_paths))
     __write_job_metadata(metadata)
+    __report_sniff_stats()
 
 
 if __name__ == '__main__':